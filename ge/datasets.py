@@ -1,14 +1,19 @@
+import os
 import abc
+import glob
+import json
 import logging
 from typing import List, Union
 
+import numpy as np
 import pandas as pd
 import torch
 import dgl
 
-from ge.params import _DataParams, Acct2AssetDataParams
+from ge.params import _DataParams, Acct2AssetDataParams, canonical_hash
 from ge.db_utils import _DataBaseConnector, _CloudStorageConnector
 from ge.operators import _Operator, OperatorPipeline
+from ge.utils import check_and_mkdir
 
 
 logger = logging.getLogger('ge')
@@ -25,14 +30,55 @@ class _Datasets(abc.ABC):
         self.verbose = verbose
 
 
+class GraphCache:
+    # Built graphs on local disk, one dgl.save_graphs file per key with its node-id mapping in ndata['nid'].
+    # Hits refresh the file time, and the least recently used graphs are evicted beyond max_size bytes.
+    def __init__(self, cache_dir: str, max_size: int = 2 ** 34):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, f'graph_{key}.bin')
+
+    def get(self, key: str):
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return dgl.load_graphs(path)[0][0]
+
+    def put(self, key: str, g: dgl.DGLGraph, meta: dict = None):
+        path = self.path(key)
+        check_and_mkdir(path)
+        # Written under a temporary name, so a crash never leaves a truncated graph behind.
+        dgl.save_graphs(path + '.tmp', [g])
+        os.replace(path + '.tmp', path)
+        with open(os.path.join(self.cache_dir, f'graph_{key}.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta or {}, key=key), f)
+        self.evict(keep=key)
+        return path
+
+    def evict(self, keep: str = None):
+        entries = sorted(glob.glob(os.path.join(self.cache_dir, 'graph_*.bin')), key=os.path.getmtime, reverse=True)
+        total = 0
+        for path in entries:
+            total += os.path.getsize(path)
+            if total > self.max_size and path != self.path(keep):
+                os.remove(path)
+                meta_path = path[:-len('.bin')] + '.json'
+                if os.path.exists(meta_path):
+                    os.remove(meta_path)
+
+
 class Acct2AssetDatasets(_Datasets):
     def __init__(self, data_params: Acct2AssetDataParams, operators: List[Union[_Operator, str, type]],
                  db_connector: _DataBaseConnector = None, cs_connector: _CloudStorageConnector = None,
-                 verbose: bool = True):
+                 cache_dir: str = None, cache_size: int = 2 ** 34, verbose: bool = True):
         super().__init__(data_params=data_params, operators=operators,
                          db_connector=db_connector, cs_connector=cs_connector,
                          verbose=verbose)
         self._preprocessed = False
+        self.cache = GraphCache(cache_dir, max_size=cache_size) if cache_dir is not None else None
 
     @property
     def preprocess_query(self):
@@ -53,7 +99,7 @@ class Acct2AssetDatasets(_Datasets):
 
     def get_node_type_mapping(self):
         type_mapping = {a: i + 1 for i, a in enumerate(self.data_params.assets)}
-        type_mapping[0] = self.data_params.src_type_value
+        type_mapping[self.data_params.src_type_value] = 0
         return type_mapping
 
     def get_dgl_graph(self):
@@ -65,31 +111,60 @@ class Acct2AssetDatasets(_Datasets):
 
         p = self.data_params
 
-        df = self.db_connector.download_table(p.save_db)
-
-        src_node_data = df[[p.src_id_col]].drop_duplicates().reset_index(drop=True)
-        src_node_data[p.tgt_type_col] = p.src_type_value
-        src_node_data = src_node_data.rename(columns={p.src_id_col: 'int_node_id', p.tgt_type_col: 'node_type'})
-
-        tgt_node_data = df[[p.tgt_id_col, p.tgt_type_col]].drop_duplicates().reset_index(drop=True)
-        tgt_node_data = tgt_node_data.rename(columns={p.tgt_id_col: 'int_node_id', p.tgt_type_col: 'node_type'})
+        key = None
+        if self.cache is not None:
+            # The key follows the parameters, the preprocessing query and the size of the table it filled.
+            n_rows = int(self.db_connector.count_table(p.save_db).iloc[0, 0])
+            key = canonical_hash({'params': p, 'query': self.preprocess_query, 'n_rows': n_rows})
+            g = self.cache.get(key)
+            if g is not None:
+                if self.verbose:
+                    logger.info(f'Done: load dgl graph from cache {self.cache.path(key)}.\nGraph statistics:\n{g}')
+                return g
 
-        node_data = pd.concat([src_node_data, tgt_node_data]).reset_index(drop=True)
-        nid_mapping = node_data.reset_index().set_index('int_node_id')['index']
+        df = self.db_connector.download_table(p.save_db)
+        src = df[p.src_id_col].to_numpy()
+        tgt = df[p.tgt_id_col].to_numpy()
+        tgt_type = df[p.tgt_type_col].to_numpy()
+        weight = df[p.edge_weight_col].to_numpy(dtype=np.float32) if p.edge_weight_col in df.columns else None
+        del df
+
+        # One hash pass per side: ids are given in order of first appearance, accounts first, like the
+        # drop_duplicates/concat index they replace.
+        u, src_nid = pd.factorize(src)
+        del src
+        v, tgt_nid = pd.factorize(tgt)
+        del tgt
+        n_src, n_nodes = len(src_nid), len(src_nid) + len(tgt_nid)
+        # Codes appear in increasing order, so the rows where a new maximum starts are first occurrences.
+        tgt_first = np.flatnonzero(v > np.maximum.accumulate(np.concatenate([[-1], v[:-1]])))
         type_mapping = self.get_node_type_mapping()
-        node_data['node_type_id'] = node_data['node_type'].map(type_mapping)
-
-        df['dgl_' + p.src_id_col] = df[p.src_id_col].map(nid_mapping)
-        df['dgl_' + p.tgt_id_col] = df[p.tgt_id_col].map(nid_mapping)
-
-        u = torch.tensor(df['dgl_' + p.src_id_col].values, dtype=torch.int64)
-        v = torch.tensor(df['dgl_' + p.tgt_id_col].values, dtype=torch.int64)
-
-        g = dgl.graph((u, v))
-        g.ndata['nid'] = torch.tensor(node_data['int_node_id'].values, dtype=torch.int64)
-        g.ndata['tid'] = torch.tensor(node_data['node_type_id'].values, dtype=torch.int64)
-        g = dgl.to_bidirected(g, copy_ndata=True)
-
+        tid = np.empty(n_nodes, dtype=np.int64)
+        tid[:n_src] = type_mapping[p.src_type_value]
+        tid[n_src:] = pd.Series(tgt_type[tgt_first]).map(type_mapping).to_numpy()
+        del tgt_type, tgt_first
+        v += n_src
+
+        # Repeated rows are one edge, as to_bidirected made them, and their weights add up.
+        edge, first = pd.factorize(u * n_nodes + v)
+        if len(first) < len(edge):
+            if weight is not None:
+                weight = np.bincount(edge, weights=weight, minlength=len(first)).astype(np.float32)
+            u, v = first // n_nodes, first % n_nodes
+        del edge, first
+
+        # Both directions are laid out at once instead of copying the graph through to_bidirected: edge i
+        # is u[i] -> v[i] and edge n_edges + i its reverse, so edge data lines up with the input rows.
+        g = dgl.graph((torch.from_numpy(np.concatenate([u, v])), torch.from_numpy(np.concatenate([v, u]))),
+                      num_nodes=n_nodes)
+        del u, v
+        if weight is not None:
+            g.edata['weight'] = torch.from_numpy(np.concatenate([weight, weight]))
+        g.ndata['nid'] = torch.from_numpy(np.concatenate([src_nid, tgt_nid]).astype(np.int64))
+        g.ndata['tid'] = torch.from_numpy(tid)
+
+        if self.cache is not None:
+            self.cache.put(key, g, meta={'save_db': p.save_db, 'n_rows': n_rows})
         if self.verbose:
             logger.info(f'Done: build dgl graph.\nGraph statistics:\n{g}')
         return g
@@ -2,76 +2,418 @@ import dgl
 import numpy as np
 import tqdm
 import torch
-from sklearn.metrics import pairwise_distances
-
-
-def kg_metrics(g: dgl.DGLGraph, emb: np.array, n_sample: int, batch: int = 100, verbose: bool = True) -> dict:
-    rank = list()
-    nodes = torch.randperm(g.num_nodes())[:n_sample]
-
-    for idx in tqdm.tqdm(range(n_sample // batch + int(n_sample % batch != 0)), disable=not verbose):
-        start, end = idx * batch, (idx + 1) * batch
-
-        dist = pairwise_distances(emb[nodes[start: end]], emb, metric='cosine', n_jobs=-1)
-        for node, ds in zip(nodes[start: end], dist):
-            ns = g.successors(node)
-            nds = ds[ns]
-            nds = np.array([nds]) if not isinstance(nds, np.ndarray) else nds
-            nds = np.sort(nds)
-
-            for i, d in enumerate(nds):
-                r = (ds < d).sum() - i
-                rank.append(r)
-    ret = {
-        'MRR': sum([1 / r for r in rank]) / len(rank),
-        'MR': sum(rank) / len(rank),
-        'HITS@1': sum([1 if r <= 1 else 0 for r in rank]) / len(rank),
-        'HITS@3': sum([1 if r <= 3 else 0 for r in rank]) / len(rank),
-        'HITS@10': sum([1 if r <= 10 else 0 for r in rank]) / len(rank),
-        '_rank': rank
-    }
-    return ret
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from ge.utils import csr_adj, torch_threads
+
+
+def kg_metrics(g: dgl.DGLGraph, emb: np.array, n_sample: int, batch: int = None, memory_budget: int = 2 ** 28,
+               seed: int = None, n_keep: int = 10000, index=None, n_probe: int = 8, verbose: bool = True) -> dict:
+    # Ranks are streamed into a RankAccumulator, '_rank' only holds a reservoir sample of n_keep of them.
+    # With an IVFIndex of emb the ranks are approximate, see iter_ivf_rank, and emb is not read.
+    # Zero rows, as models return for nodes they have no embedding for, are left out of the ranking and
+    # the sampled ones are counted in 'n_skipped'.
+    nodes = _sample_nodes(g, n_sample, seed)
+    if index is not None:
+        acc = RankAccumulator(n_keep=n_keep, seed=seed)
+        for query, indptr, indices in _neighbor_blocks(g, nodes, batch or 1024, verbose=verbose):
+            for rank in iter_ivf_rank(index, query, indptr, indices, n_probe=n_probe, batch=len(query)):
+                acc.add(rank)
+        n_skipped = int((~np.asarray(index.vectors[index.position[nodes]]).any(axis=1)).sum())
+        return dict(acc.metrics(), n_skipped=n_skipped)
+
+    # Normalized once, the cosine similarity of a block is then a single float32 matrix product.
+    emb = np.asarray(emb, dtype=np.float32)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    emb = emb / np.maximum(norms, 1e-12)
+    if batch is None:
+        batch = max(1, memory_budget // (_BLOCK_BYTES * emb.shape[0]))
+    # The rows are unit already, zero norms only flag the rows to leave out.
+    norms = (norms[:, 0] > 0).astype(np.float32)
+    acc = RankAccumulator(n_keep=n_keep, seed=seed)
+    for query, indptr, indices in _neighbor_blocks(g, nodes, batch, verbose=verbose):
+        for rank in iter_sampled_rank(emb, query, indptr, indices, norms=norms, batch=len(query)):
+            acc.add(rank)
+    return dict(acc.metrics(), n_skipped=int((norms[nodes] == 0).sum()))
+
+
+def kg_metrics_torch(g: dgl.DGLGraph, emb: np.array, n_sample: int, batch: int = None,
+                     memory_budget: int = 2 ** 28, device: str = 'cpu', n_jobs: int = None, seed: int = None,
+                     n_keep: int = 10000, verbose: bool = True) -> dict:
+    # Same sample and ranks as kg_metrics, with the blocks scored and ranked by torch on the device. On CPU
+    # the numpy sort of kg_metrics is faster than bucketing, so it is used with n_jobs torch threads.
+    if torch.device(device).type == 'cpu':
+        with torch_threads(n_jobs):
+            return kg_metrics(g, emb, n_sample, batch=batch, memory_budget=memory_budget, seed=seed,
+                              n_keep=n_keep, verbose=verbose)
+
+    nodes = _sample_nodes(g, n_sample, seed)
+
+    emb = np.asarray(emb, dtype=np.float32)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    emb = torch.from_numpy(emb / np.maximum(norms, 1e-12)).to(device)
+    valid = torch.from_numpy(norms[:, 0] > 0).to(device)
+    n_nodes = emb.shape[0]
+    if batch is None:
+        batch = max(1, memory_budget // (_BLOCK_BYTES * n_nodes))
+
+    acc = RankAccumulator(n_keep=n_keep, seed=seed)
+    with torch_threads(n_jobs):
+        for block_nodes in _neighbor_blocks(g, nodes, batch, verbose=verbose):
+            query, indptr, indices = (torch.from_numpy(a).to(device) for a in block_nodes)
+            b = len(query)
+            sims = emb[query] @ emb.T
+
+            block = torch.arange(b, device=device)
+            rows = torch.repeat_interleave(block, indptr[1:] - indptr[:-1])
+            nbr = indices
+            keep = (nbr != query[rows]) & valid[nbr] & valid[query][rows]
+            rows, nbr = rows[keep], nbr[keep]
+            nbr_sims = sims[rows, nbr]
+            sims[block, query] = -2
+            sims[:, ~valid] = -2
+
+            # Position of every neighbour among the neighbours of its row, by decreasing similarity, and
+            # the number of them strictly closer, so that tied neighbours do not push each other down.
+            order = torch.sort(-nbr_sims, stable=True).indices
+            order = order[torch.sort(rows[order], stable=True).indices]
+            deg = torch.bincount(rows, minlength=b)
+            row_start = (torch.cumsum(deg, 0) - deg)[rows[order]]
+            step = torch.arange(len(order), device=device)
+            first = torch.ones(len(order), dtype=torch.bool, device=device)
+            first[1:] = (rows[order][1:] != rows[order][:-1]) | (nbr_sims[order][1:] != nbr_sims[order][:-1])
+            pos, within = torch.empty_like(order), torch.empty_like(order)
+            pos[order] = step - row_start
+            within[order] = torch.cummax(torch.where(first, step, 0), 0).values - row_start
+
+            # Rather than sorting the block, every row is bucketed by its own ascending neighbour
+            # similarities, and a suffix sum of the buckets counts the closer nodes.
+            width = int(deg.max()) + 1 if len(rows) > 0 else 1
+            asc = deg[rows] - 1 - pos
+            bounds = torch.full((b, width), float('inf'), device=device)
+            bounds[rows, asc] = nbr_sims
+            slot = torch.searchsorted(bounds, sims) + width * block[:, None]
+            del sims
+            closer = torch.bincount(slot.view(-1), minlength=b * width).view(b, width)
+            del slot
+            closer = torch.flip(torch.cumsum(torch.flip(closer, (1,)), 1), (1,))
+            greater = closer[rows, asc + 1]
+            acc.add((1 + greater - within)[order].cpu().numpy())
+    return dict(acc.metrics(), n_skipped=int((~valid[torch.from_numpy(nodes).to(device)]).sum()))
 
 
 def kg_metrics_cuda(g: dgl.DGLGraph, emb: np.array, n_sample: int, verbose: bool = True,
-                    device: str = 'cuda') -> dict:
-    rank = list()
-    nodes = torch.randperm(g.num_nodes())[:n_sample].to(device)
-    emb = torch.tensor(emb).to(device)
-    g = g.to(device)
-
-    def get_similarity(node_id):
-        res = list()
-        b = 1000000
-        for i in range(emb.shape[0] // b + int(emb.shape[0] % b != 0)):
-            r = 1 - torch.nn.functional.cosine_similarity(
-                emb[node_id:node_id + 1, :, None],
-                emb[i * b: (i + 1) * b].t()[None, :, :]
-            )
-            res.append(r)
-        return torch.cat(res, dim=1)[0]
-
-    def get_rank(n):
-        ns = g.successors(n)
-        ds = get_similarity(n)
-        nds = ds[ns]
-        nds, _ = torch.sort(nds)
-        res = [((ds < d).sum() - i).cpu().item() for i, d in enumerate(nds)]
-        return res
-
-    for node in tqdm.tqdm(nodes, disable=not verbose):
-        rank += get_rank(node)
-
-    ret = {
-        'MRR': sum([1 / r for r in rank]) / len(rank),
-        'MR': sum(rank) / len(rank),
-        'HITS@1': sum([1 if r <= 1 else 0 for r in rank]) / len(rank),
-        'HITS@3': sum([1 if r <= 3 else 0 for r in rank]) / len(rank),
-        'HITS@10': sum([1 if r <= 10 else 0 for r in rank]) / len(rank),
-        '_rank': rank
-    }
-    return ret
+                    device: str = 'cuda', seed: int = None) -> dict:
+    return kg_metrics_torch(g, emb, n_sample, device=device, seed=seed, verbose=verbose)
+
+
+def _sample_nodes(g: dgl.DGLGraph, n_sample: int, seed: int = None) -> np.ndarray:
+    # Without a seed the sample follows the global torch RNG, as torch.manual_seed callers expect.
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    return torch.randperm(g.num_nodes(), generator=generator)[:n_sample].numpy()
+
+
+class RankAccumulator:
+    # Running sums over a stream of ranks, so memory does not grow with the number of ranks: ranks below
+    # hist_size are counted exactly, larger ones share the last bin, and n_keep raw ranks are kept by
+    # reservoir sampling.
+    def __init__(self, hist_size: int = 1024, n_keep: int = 0, seed: int = None):
+        assert hist_size > 10, 'The histogram has to resolve HITS@10'
+        self.hist = np.zeros(hist_size, dtype=np.int64)
+        self.count = 0
+        self.rank_sum = 0.
+        self.rr_sum = 0.
+        self.n_keep = n_keep
+        self.kept = np.zeros(n_keep, dtype=np.int64)
+        self.n_kept = 0
+        self.rng = np.random.default_rng(seed)
+
+    def _reservoir(self, rank):
+        n_fill = min(len(rank), self.n_keep - self.n_kept)
+        self.kept[self.n_kept: self.n_kept + n_fill] = rank[:n_fill]
+        self.n_kept += n_fill
+        rest = rank[n_fill:]
+        if len(rest) > 0 and self.n_keep > 0:
+            # Algorithm R: the i-th rank replaces a random slot with probability n_keep / i. Numpy assigns
+            # repeated slots in order, so the last rank wins as it would one rank at a time.
+            seen = self.count + n_fill + np.arange(1, len(rest) + 1)
+            slot = (self.rng.random(len(rest)) * seen).astype(np.int64)
+            replace = slot < self.n_keep
+            self.kept[slot[replace]] = rest[replace]
+
+    def add(self, rank: np.ndarray):
+        rank = np.asarray(rank, dtype=np.int64)
+        self._reservoir(rank)
+        self.hist += np.bincount(np.minimum(rank, len(self.hist)) - 1, minlength=len(self.hist))
+        self.count += len(rank)
+        self.rank_sum += float(rank.sum())
+        self.rr_sum += float((1 / rank).sum())
+        return self
+
+    def metrics(self) -> dict:
+        count = max(self.count, 1)
+        hits = np.cumsum(self.hist)
+        return {
+            'MRR': self.rr_sum / count,
+            'MR': self.rank_sum / count,
+            'HITS@1': float(hits[0] / count),
+            'HITS@3': float(hits[2] / count),
+            'HITS@10': float(hits[9] / count),
+            '_hist': self.hist.copy(),
+            '_rank': self.kept[:self.n_kept].copy(),
+        }
+
+
+def rank_metrics(rank: np.ndarray) -> dict:
+    return RankAccumulator(n_keep=len(rank)).add(rank).metrics()
+
+
+def neighbors(g: dgl.DGLGraph, nodes: np.ndarray):
+    # Successors of nodes as a CSR block: the neighbours of nodes[i] are indices[indptr[i]: indptr[i + 1]].
+    g_indptr, g_indices, _ = csr_adj(g)
+    g_indptr, g_indices = g_indptr.numpy(), g_indices.numpy()
+    deg = g_indptr[nodes + 1] - g_indptr[nodes]
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(deg, out=indptr[1:])
+    pos = np.repeat(g_indptr[nodes] - indptr[:-1], deg) + np.arange(indptr[-1])
+    return indptr, g_indices[pos]
+
+
+def _neighbor_blocks(g: dgl.DGLGraph, nodes: np.ndarray, batch: int, verbose: bool = False):
+    # The sample in blocks of batch nodes, each with its own neighbour CSR, so that memory stays constant
+    # in the sample size.
+    for start in tqdm.tqdm(range(0, len(nodes), batch), disable=not verbose):
+        query = nodes[start: start + batch]
+        yield (query, *neighbors(g, query))
+
 
+# float32 similarities plus their float64 sorted copy, or for torch their int64 buckets.
+_BLOCK_BYTES = 12
 
-def evaluation(g: dgl.DGLGraph, emb: np.array):
-    pass
+
+def iter_sampled_rank(emb: np.ndarray, nodes: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                      norms: np.ndarray = None, batch: int = 100, verbose: bool = False):
+    # Rank of the neighbours indices[indptr[i]: indptr[i + 1]] of every nodes[i] by cosine similarity,
+    # filtered like kg_metrics: closer neighbours, or tied ones, do not push each other down. The node
+    # itself always ranks first, self loops included, so it is left out of both sides, and so are the
+    # rows of zero norm.
+    # emb is only read through matrix products, so a live model matrix can be passed without a copy.
+    if norms is None:
+        norms = np.linalg.norm(emb, axis=1)
+    valid = norms > 0
+    invalid = np.flatnonzero(~valid)
+    norms = np.maximum(norms, 1e-12).astype(emb.dtype)
+    n_nodes = emb.shape[0]
+    for start in tqdm.tqdm(range(0, len(nodes), batch), disable=not verbose):
+        query = nodes[start: start + batch]
+        b = len(query)
+        # torch runs the product on CPU, which keeps the similarities bit for bit those of kg_metrics_torch.
+        sims = (torch.from_numpy(emb[query] / norms[query, None]) @ torch.from_numpy(emb).T).numpy()
+        sims /= norms
+
+        rows = np.repeat(np.arange(b), np.diff(indptr[start: start + b + 1]))
+        nbr = indices[indptr[start]: indptr[start + b]]
+        keep = (nbr != query[rows]) & valid[nbr] & valid[query][rows]
+        rows, nbr = rows[keep], nbr[keep]
+        nbr_sims = sims[rows, nbr].astype(np.float64) + 4 * rows
+        sims[np.arange(b), query] = -2
+        sims[:, invalid] = -2
+
+        # One sort and one searchsorted for the whole block: similarities lie in [-2, 1], so shifting
+        # row j by 4 * j lays the sorted rows out as a single increasing array.
+        flat = np.sort(sims, axis=1).astype(np.float64)
+        flat += 4 * np.arange(b)[:, None]
+        greater = (rows + 1) * n_nodes - np.searchsorted(flat.ravel(), nbr_sims, side='right')
+
+        # Number of neighbours of the same row strictly closer, the first of a run of ties by decreasing
+        # similarity. The row offset keeps runs from spanning rows.
+        order = np.lexsort((-nbr_sims, rows))
+        row_start = np.zeros(b, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=b)[:-1], out=row_start[1:])
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = np.diff(nbr_sims[order]) != 0
+        within = np.empty(len(order), dtype=np.int64)
+        within[order] = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0)) - row_start[rows[order]]
+        yield (1 + greater - within)[order]
+
+
+def sampled_rank(emb: np.ndarray, nodes: np.ndarray, indptr: np.ndarray, indices: np.ndarray,
+                 norms: np.ndarray = None, batch: int = 100, verbose: bool = False) -> np.ndarray:
+    rank = list(iter_sampled_rank(emb, nodes, indptr, indices, norms=norms, batch=batch, verbose=verbose))
+    return np.concatenate(rank) if len(rank) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def iter_ivf_rank(index, nodes: np.ndarray, indptr: np.ndarray, indices: np.ndarray, n_probe: int = 8,
+                  batch: int = 1024, verbose: bool = False):
+    # Approximate filtered ranks from an IVFIndex: only the nodes of the n_probe lists closest to a query
+    # are compared with its neighbours, so ranks are lower bounds, exact for neighbours whose closer
+    # nodes all fall in the probed lists. Other neighbours are left out of the count rather than
+    # discounted afterwards, which gives the same filtered rank up to the rounding of tied similarities.
+    # Zero rows are neither ranked nor ranked against, as in iter_sampled_rank.
+    vectors = index.tensor()
+    position = index.position
+    for start in tqdm.tqdm(range(0, len(nodes), batch), disable=not verbose):
+        query = nodes[start: start + batch]
+        b = len(query)
+        q = vectors[torch.from_numpy(position[query])]
+
+        rows = torch.from_numpy(np.repeat(np.arange(b), np.diff(indptr[start: start + b + 1])))
+        nbr = indices[indptr[start]: indptr[start + b]]
+        nbr_pos = torch.from_numpy(position[nbr])
+        keep = torch.from_numpy(nbr != query[rows.numpy()]) & vectors[nbr_pos].any(1) & q.any(1)[rows]
+        rows, nbr_pos = rows[keep], nbr_pos[keep]
+        nbr_sims = (q[rows] * vectors[nbr_pos]).sum(1)
+
+        order = torch.sort(-nbr_sims, stable=True).indices
+        order = order[torch.sort(rows[order], stable=True).indices]
+        deg = torch.bincount(rows, minlength=b)
+        asc = torch.empty_like(order)
+        asc[order] = deg[rows[order]] - 1 - (torch.arange(len(order)) - (torch.cumsum(deg, 0) - deg)[rows[order]])
+        width = int(deg.max()) + 1 if len(rows) > 0 else 1
+        bounds = torch.full((b, width), float('inf'))
+        bounds[rows, asc] = nbr_sims
+
+        # Closer nodes are bucketed list by list, as in kg_metrics_torch.
+        closer = torch.zeros(b * width, dtype=torch.int64)
+        local = torch.full((b,), -1, dtype=torch.int64)
+        q_pos = torch.from_numpy(position[query])
+        for lst, qi, _ in index.probed_lists(q, n_probe):
+            a, z = int(index.offsets[lst]), int(index.offsets[lst + 1])
+            if a == z:
+                continue
+            sims = q[qi] @ vectors[a: z].T
+            sims[:, ~vectors[a: z].any(1)] = -np.inf
+            local[qi] = torch.arange(len(qi))
+            own = (q_pos[qi] >= a) & (q_pos[qi] < z)
+            sims[own, q_pos[qi][own] - a] = -np.inf
+            inside = (nbr_pos >= a) & (nbr_pos < z) & (local[rows] >= 0)
+            sims[local[rows[inside]], nbr_pos[inside] - a] = -np.inf
+            local[qi] = -1
+            slot = torch.searchsorted(bounds[qi], sims) + width * qi[:, None]
+            closer += torch.bincount(slot.view(-1), minlength=b * width)
+        closer = torch.flip(torch.cumsum(torch.flip(closer.view(b, width), (1,)), 1), (1,))
+        yield (1 + closer[rows, asc + 1])[order].numpy()
+
+
+def split_edges(g: dgl.DGLGraph, test_ratio: float = 0.1, seed: int = 0):
+    # Holds out test_ratio of the undirected edges, both directions of each, but never an edge of a random
+    # spanning forest: every connected component of g stays connected in the training graph.
+    rng = np.random.default_rng(seed)
+    n = g.num_nodes()
+    src, dst = (x.numpy() for x in g.edges())
+    # Parallel edges are one pair, held out or kept as a whole.
+    edge_key = np.minimum(src, dst) * n + np.maximum(src, dst)
+    key = np.unique(edge_key[src != dst])
+    src, dst = key // n, key % n
+    forest = minimum_spanning_tree(coo_matrix((rng.random(len(src)) + 1, (src, dst)), shape=(n, n))).tocoo()
+    tree = np.isin(key, np.minimum(forest.row, forest.col) * n + np.maximum(forest.row, forest.col))
+    candidates = np.flatnonzero(~tree)
+    test = np.sort(rng.choice(candidates, size=min(len(candidates), int(round(test_ratio * len(src)))),
+                              replace=False))
+    test_src, test_dst = src[test], dst[test]
+    if 'tid' in g.ndata:
+        # Test edges point from the account to the asset, so they are grouped by the asset type.
+        tid = g.ndata['tid'].numpy()
+        flip = tid[test_src] > tid[test_dst]
+        test_src, test_dst = np.where(flip, test_dst, test_src), np.where(flip, test_src, test_dst)
+    train_g = dgl.remove_edges(g, torch.from_numpy(np.flatnonzero(np.isin(edge_key, key[test]))))
+    return train_g, (test_src, test_dst)
+
+
+class _ScoreHistogram:
+    # Scores binned on a fixed range, so AUC and AP are computed in constant memory from any number of edges.
+    def __init__(self, n_groups: int, lo: float, hi: float, bins: int):
+        self.lo, self.hi, self.bins = lo, hi, bins
+        self.pos = np.zeros((n_groups, bins), dtype=np.int64)
+        self.neg = np.zeros((n_groups, bins), dtype=np.int64)
+
+    def _bin(self, score):
+        return np.clip(((score - self.lo) / (self.hi - self.lo) * self.bins).astype(np.int64), 0, self.bins - 1)
+
+    def add(self, group, score, positive):
+        hist = self.pos if positive else self.neg
+        np.add.at(hist, (group, self._bin(score)), 1)
+
+    @staticmethod
+    def metrics(pos, neg):
+        n_pos, n_neg = pos.sum(), neg.sum()
+        if n_pos == 0 or n_neg == 0:
+            return {'AUC': 0., 'AP': 0.}
+        # Pairs falling in the same bin count as ties.
+        neg_below = np.cumsum(neg) - neg
+        auc = (pos * (neg_below + neg / 2)).sum() / (n_pos * n_neg)
+        tp, fp = np.cumsum(pos[::-1]), np.cumsum(neg[::-1])
+        ap = (pos[::-1] * tp / np.maximum(tp + fp, 1)).sum() / n_pos
+        return {'AUC': float(auc), 'AP': float(ap)}
+
+
+def evaluation(g: dgl.DGLGraph, emb: np.array, test_edges: tuple, n_negative: int = 100, score: str = 'cosine',
+               memory_budget: int = 2 ** 28, bins: int = 2 ** 16, seed: int = 0, verbose: bool = True) -> dict:
+    # Link prediction on held out edges, see split_edges: g is the training graph and emb was trained on it.
+    # Every test edge is scored against n_negative corrupted tails of the same type as its tail. Corruptions
+    # that are edges of g or test edges themselves are discarded. Metrics are reported overall and by
+    # the type of the tail, under 'by_type'.
+    assert score in ('cosine', 'dot'), f'Unknown score {score}'
+    rng = np.random.default_rng(seed)
+    test_src, test_dst = (np.asarray(x, dtype=np.int64) for x in test_edges)
+    n = g.num_nodes()
+    tid = g.ndata['tid'].numpy() if 'tid' in g.ndata else np.zeros(n, dtype=np.int64)
+    n_types = int(tid.max()) + 1
+    type_order = np.argsort(tid, kind='stable')
+    type_offset = np.zeros(n_types + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tid, minlength=n_types), out=type_offset[1:])
+    test_keys = np.sort(np.concatenate([test_src * n + test_dst, test_dst * n + test_src]))
+
+    # Cosine scores lie in [-1, 1], dot products are binned through a sigmoid.
+    hist = _ScoreHistogram(n_types, -1., 1., bins) if score == 'cosine' else _ScoreHistogram(n_types, 0., 1., bins)
+    count = np.zeros(n_types, dtype=np.int64)
+    rank_sum, rr_sum = np.zeros(n_types), np.zeros(n_types)
+    hits = {k: np.zeros(n_types, dtype=np.int64) for k in (1, 3, 10)}
+
+    emb = np.asarray(emb)
+    batch = max(1, memory_budget // (4 * (n_negative + 2) * emb.shape[1]))
+    for start in tqdm.tqdm(range(0, len(test_src), batch), disable=not verbose):
+        head, tail = test_src[start: start + batch], test_dst[start: start + batch]
+        group = tid[tail]
+        size = (type_offset[group + 1] - type_offset[group])[:, None]
+        neg = type_order[type_offset[group][:, None] + (rng.random((len(tail), n_negative)) * size).astype(np.int64)]
+        neg_keys = head[:, None] * n + neg
+        pos_in = np.searchsorted(test_keys, neg_keys)
+        valid = ~g.has_edges_between(torch.from_numpy(np.repeat(head, n_negative)),
+                                     torch.from_numpy(neg.ravel())).numpy().reshape(neg.shape)
+        valid &= test_keys[np.minimum(pos_in, len(test_keys) - 1)] != neg_keys
+
+        h, t, t_neg = (emb[x].astype(np.float32) for x in (head, tail, neg))
+        pos_score = (h * t).sum(1)
+        neg_score = np.matmul(t_neg, h[:, :, None])[:, :, 0]
+        if score == 'cosine':
+            h_norm = np.maximum(np.linalg.norm(h, axis=1), 1e-12)
+            pos_score /= h_norm * np.maximum(np.linalg.norm(t, axis=1), 1e-12)
+            neg_score /= h_norm[:, None] * np.maximum(np.linalg.norm(t_neg, axis=2), 1e-12)
+        else:
+            pos_score, neg_score = 1 / (1 + np.exp(-pos_score)), 1 / (1 + np.exp(-neg_score))
+
+        hist.add(group, pos_score, positive=True)
+        hist.add(np.broadcast_to(group[:, None], neg.shape)[valid], neg_score[valid], positive=False)
+        rank = 1 + ((neg_score > pos_score[:, None]) & valid).sum(1)
+        count += np.bincount(group, minlength=n_types)
+        rank_sum += np.bincount(group, weights=rank, minlength=n_types)
+        rr_sum += np.bincount(group, weights=1 / rank, minlength=n_types)
+        for k in hits:
+            hits[k] += np.bincount(group, weights=rank <= k, minlength=n_types).astype(np.int64)
+
+    def summary(types):
+        c = max(int(count[types].sum()), 1)
+        ret = _ScoreHistogram.metrics(hist.pos[types].sum(0), hist.neg[types].sum(0))
+        ret.update({
+            'MRR': float(rr_sum[types].sum() / c),
+            'MR': float(rank_sum[types].sum() / c),
+            **{f'HITS@{k}': float(hits[k][types].sum() / c) for k in hits},
+            'n_edges': int(count[types].sum()),
+        })
+        return ret
+
+    ret = summary(np.arange(n_types))
+    ret['by_type'] = {t: summary(np.array([t])) for t in range(n_types) if count[t] > 0}
+    return ret
@@ -1,3 +1,6 @@
-from ge.models.deepwalk import DeepWalk
+from ge.models.deepwalk import DeepWalk, EarlyStopping
 from ge.models.node2vect_walk import Node2VecWalk
+from ge.models.skipgram import SkipGram
+from ge.models.transe import TransE
+from ge.models.partitioned import PartitionedModel
 
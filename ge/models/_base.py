@@ -1,6 +1,13 @@
+import os
 import abc
 import pickle
 
+import numpy as np
+
+from ge.models.utils.store import EmbeddingStore
+from ge.models.utils.walkers import RandomWalk
+from ge.utils import check_and_mkdir
+
 
 class _Model:
     @abc.abstractmethod
@@ -16,11 +23,94 @@ class _Model:
         raise NotImplementedError
 
     @abc.abstractmethod
-    def save_embedding(self, path):
+    def get_embedding(self, *args, **kwargs):
         raise NotImplementedError
 
+    def _export_embedding(self, vectors: np.ndarray, index: np.ndarray = None, missing: np.ndarray = None,
+                          dtype: type = np.float32, out: [np.ndarray, str, None] = None,
+                          block_size: int = 2 ** 16):
+        # Node i gets vectors[index[i]], or vectors[i] without an index, and zeros where index is -1 or
+        # i is in missing. out is an array, or a path written as a memory-mapped .npy, filled block by block.
+        n_nodes = self.g.num_nodes()
+        if index is None:
+            index = np.arange(n_nodes)
+            if missing is not None:
+                index[missing] = -1
+        missing = np.flatnonzero(index < 0)
+        shape = (n_nodes, vectors.shape[1])
+        if out is None:
+            emb = vectors[np.maximum(index, 0)].astype(dtype, copy=False)
+            emb[missing] = 0
+        else:
+            if isinstance(out, str):
+                check_and_mkdir(out)
+                out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+            assert out.shape == shape, f'Expect output of shape {shape}, got {out.shape}'
+            for start in range(0, n_nodes, block_size):
+                idx = index[start: start + block_size]
+                block = vectors[np.maximum(idx, 0)]
+                block[idx < 0] = 0
+                out[start: start + block_size] = block
+            emb = out
+        return emb, missing
+
+    def save_embedding(self, path, fmt: str = 'pickle', quantize: str = None):
+        assert fmt in ('pickle', 'store'), f'Unknown embedding format {fmt}'
+        emb = self.get_embedding()
+
+        if fmt == 'store':
+            EmbeddingStore.from_graph(self.g, emb).save(path, quantize=quantize)
+            return self
+
+        check_and_mkdir(path)
+        with open(path, 'wb') as f:
+            pickle.dump(emb, f)
+        return self
+
     @staticmethod
-    def load_embedding(path):
+    def load_embedding(path, mmap_mode: str = None):
+        if os.path.isdir(path):
+            return EmbeddingStore.load(path, mmap_mode=mmap_mode)
         with open(path, 'rb') as f:
             emb = pickle.load(f)
         return emb
+
+
+class _WalkModel(_Model):
+    # Models trained on RandomWalk corpora: the walker is configured from the model attributes.
+    def _init_walker(self, **kwargs):
+        return RandomWalk(
+            g=self.g,
+            walk_length=self.walk_length,
+            batch_size=self.batch_size,
+            memory_budget=self.memory_budget,
+            n_jobs=self.walk_jobs,
+            seed=self.seed,
+            cache_dir=self.cache_dir,
+            graph_id=self.graph_id,
+            node_type=self.node_type,
+            metapath=self.metapath,
+            type_mapping=self.type_mapping,
+            num_walks_per_node=self.num_walks_per_node,
+            weight=self.weight,
+            start_sampling=self.start_sampling,
+            verbose=self.verbose,
+            **kwargs
+        )
+
+    def _emitted_types(self):
+        types = self.node_type if self.node_type is not None else self.metapath
+        return None if types is None else self.iter_path._type_ids(types)
+
+    def _emitted_mask(self):
+        types = self._emitted_types()
+        if types is None:
+            return np.ones(self.g.num_nodes(), dtype=bool)
+        return np.isin(self.g.ndata['tid'].numpy(), types)
+
+    def _visit_weights(self):
+        # Walks visit a node in proportion to its degree, or to its weighted degree for weighted walks.
+        if self.weight is not None:
+            return np.bincount(self.g.edges()[1].numpy(), weights=self.g.edata[self.weight].numpy(),
+                               minlength=self.g.num_nodes())
+        return self.g.in_degrees().numpy().astype(np.float64)
@@ -1,24 +1,33 @@
+import os
+import json
 import time
+import shutil
 import logging
+import tempfile
 import multiprocessing as mp
-import pickle
 import numpy as np
 import dgl
+import torch
 import tqdm
 from gensim.models import Word2Vec
 from gensim.models.callbacks import CallbackAny2Vec
 
-from ge.models._base import _Model
-from ge.models.utils.walkers import RandomWalk
-from ge.utils import check_and_mkdir
+from ge.evaluation import neighbors, rank_metrics, sampled_rank
+from ge.models._base import _WalkModel
+from ge.utils import changed_nodes, check_and_mkdir, map_nid
 
 logger = logging.getLogger('ge')
 
 
 class Callback(CallbackAny2Vec):
-    def __init__(self, epoch=0, last_total_loss=0, verbose=True):
+    def __init__(self, epoch=0, last_total_loss=0, checkpoint_dir=None, checkpoint_every=1, keep_checkpoints=1,
+                 walker=None, verbose=True):
         self.epoch = epoch
         self.last_total_loss = last_total_loss
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.keep_checkpoints = keep_checkpoints
+        self.walker = walker
         self.verbose = verbose
         self.start_time = time.time()
 
@@ -36,67 +45,324 @@ class Callback(CallbackAny2Vec):
         if self.verbose:
             logger.info('Loss after epoch {}: {}'.format(self.epoch, loss))
         self.epoch += 1
+        if self.checkpoint_dir is not None and self.epoch % self.checkpoint_every == 0:
+            self.save_checkpoint(model)
+
+    def save_checkpoint(self, model):
+        path = os.path.join(self.checkpoint_dir, f'epoch_{self.epoch}')
+        model_path = os.path.join(path, 'model')
+        check_and_mkdir(model_path)
+        model.save(model_path)
+        state = {
+            'epoch': self.epoch,
+            'last_total_loss': self.last_total_loss,
+            # The walk pass to continue from, seeded walks repeat for a given pass.
+            'walk_epoch': self.walker._epoch if self.walker is not None else 0,
+        }
+        # state.json is written last and marks the checkpoint as complete.
+        with open(os.path.join(path, 'state.json'), 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        if self.verbose:
+            logger.info(f'Save checkpoint {path}')
+        for old in self.list_checkpoints(self.checkpoint_dir)[:-self.keep_checkpoints]:
+            shutil.rmtree(old)
+
+    @staticmethod
+    def list_checkpoints(checkpoint_dir):
+        if os.path.exists(os.path.join(checkpoint_dir, 'state.json')):
+            return [checkpoint_dir]
+        if not os.path.isdir(checkpoint_dir):
+            return []
+        paths = [os.path.join(checkpoint_dir, d) for d in os.listdir(checkpoint_dir) if d.startswith('epoch_')]
+        paths = [p for p in paths if os.path.exists(os.path.join(p, 'state.json'))]
+        return sorted(paths, key=lambda p: int(os.path.basename(p).split('_')[-1]))
+
+
+class _StopTraining(Exception):
+    pass
 
 
-class DeepWalk(_Model):
+class EarlyStopping(CallbackAny2Vec):
+    # Stops training once a sampled link metric on the live vectors stops improving.
+    def __init__(self, metric: str = 'MRR', n_sample: int = 256, patience: int = 2, min_delta: float = 1e-4,
+                 batch: int = 64, seed: int = 0, verbose: bool = True):
+        self.metric = metric
+        self.n_sample = n_sample
+        self.patience = patience
+        self.min_delta = min_delta
+        self.batch = batch
+        self.seed = seed
+        self.verbose = verbose
+        self.history = list()
+        self.best = -np.inf
+        self.wait = 0
+        self._query = None
+
+    def attach(self, g: dgl.DGLGraph, index: np.ndarray):
+        # Fix the node sample and its neighbours once, already translated to vocab rows.
+        self.history, self.best, self.wait = list(), -np.inf, 0
+        rng = np.random.default_rng(self.seed)
+        nodes = np.flatnonzero(index >= 0)
+        nodes = np.sort(rng.choice(nodes, size=min(self.n_sample, len(nodes)), replace=False))
+        g_indptr, g_indices = neighbors(g, nodes)
+        rows = np.repeat(np.arange(len(nodes)), np.diff(g_indptr))
+        dst = index[g_indices]
+        keep = dst >= 0
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(nodes)), out=indptr[1:])
+        self._query = (index[nodes], indptr, dst[keep])
+        return self
+
+    def on_epoch_end(self, model):
+        start_time = time.time()
+        model.wv.fill_norms(force=True)
+        rank = sampled_rank(model.wv.vectors, *self._query, norms=model.wv.norms, batch=self.batch)
+        score = rank_metrics(rank)[self.metric]
+        self.history.append(score)
+        if self.verbose:
+            logger.info(f'Sampled {self.metric} {score:.4f}, time cost {time.time() - start_time:.2f}')
+        if score > self.best + self.min_delta:
+            self.best, self.wait = score, 0
+        else:
+            self.wait += 1
+        if self.wait >= self.patience:
+            if self.verbose:
+                logger.info(f'Stop training, {self.metric} has not improved for {self.wait} epochs')
+            raise _StopTraining
+
+
+class DeepWalk(_WalkModel):
     def __init__(self, g: dgl.DGLGraph, walk_length: int = 200, window: int = 10, emb_size: int = 64,
-                 batch_size: int = 1e7, epochs: int = 3, n_jobs: int = -1, verbose: bool = True):
+                 batch_size: int = None, memory_budget: int = 2 ** 30, epochs: int = 3,
+                 n_jobs: int = -1, walk_jobs: int = 1,
+                 seed: int = None, cache_dir: str = None, graph_id: str = None,
+                 corpus_mode: str = 'iterable', corpus_path: str = None, vocab: str = 'corpus',
+                 loss: str = 'hs', negative: int = 5,
+                 node_type: list = None, metapath: list = None, type_mapping: dict = None,
+                 num_walks_per_node: int = 1, weight: str = None, start_sampling: str = 'uniform',
+                 checkpoint_dir: str = None, checkpoint_every: int = 1, keep_checkpoints: int = 1,
+                 early_stopping: EarlyStopping = None, verbose: bool = True):
+        assert corpus_mode in ('iterable', 'corpus_file'), f'Unknown corpus mode {corpus_mode}'
+        assert vocab in ('corpus', 'graph'), f'Unknown vocab source {vocab}'
+        assert loss in ('hs', 'ns'), f'Unknown loss {loss}'
         self.g = g
         self.walk_length = walk_length
         self.emb_size = emb_size
         self.window = window
         self.batch_size = batch_size
+        self.memory_budget = memory_budget
         self.epochs = epochs
         self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count() - 1
+        self.walk_jobs = walk_jobs if walk_jobs != -1 else mp.cpu_count() - 1
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.graph_id = graph_id
+        self.corpus_mode = corpus_mode
+        self.corpus_path = corpus_path
+        self.vocab = vocab
+        self.loss = loss
+        self.negative = negative
+        self.node_type = node_type
+        self.metapath = metapath
+        self.type_mapping = type_mapping
+        self.num_walks_per_node = num_walks_per_node
+        self.weight = weight
+        self.start_sampling = start_sampling
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_every = checkpoint_every
+        self.keep_checkpoints = keep_checkpoints
+        self.early_stopping = early_stopping
         self.verbose = verbose
-        self.iter_path = RandomWalk(self.g, walk_length=self.walk_length, batch_size=self.batch_size)
-        self.model = Word2Vec(
+        self.iter_path = self._init_walker()
+        if self.vocab == 'corpus' and self.corpus_mode == 'iterable' and self.loss == 'hs' \
+                and (self._emitted_types() is not None or not self.iter_path.starts_every_node):
+            # gensim assigns huffman codes through int keys as if they were indices, so an int keyed
+            # vocabulary must hold every node id when the walks only visit some of them: filtered types,
+            # or degree sampled starts, which skip isolated nodes and may miss low degree ones.
+            self.vocab = 'graph'
+        self.model = self._init_model()
+
+    def _init_model(self):
+        model = Word2Vec(
             vector_size=self.emb_size,
             sg=1,
-            hs=1,
+            hs=int(self.loss == 'hs'),
+            negative=0 if self.loss == 'hs' else self.negative,
             workers=self.n_jobs,
             window=self.window,
             epochs=self.epochs,
             min_count=1,
+            seed=self.seed if self.seed is not None else 1,
         )
+        if self.vocab == 'graph':
+            # Keep vocab index i == dgl node i instead of sorting by frequency.
+            model.sorted_vocab = 0
+        return model
 
-    def _build_vocab(self):
+    def _write_corpus(self):
+        if self.corpus_path is not None:
+            path = self.corpus_path
+            check_and_mkdir(path)
+        else:
+            fd, path = tempfile.mkstemp(suffix='.txt', dir=self.cache_dir)
+            os.close(fd)
         if self.verbose:
-            logger.info('Start to build vocab')
+            logger.info(f'Start to write walk corpus into {path}')
         start_time = time.time()
-        self.model.build_vocab(corpus_iterable=tqdm.tqdm(self.iter_path, disable=not self.verbose))
+        n_words = self.iter_path.to_txt(path)
         if self.verbose:
-            logger.info(f'Finish to build vocab, time costs {time.time() - start_time:.2f}')
+            logger.info(f'Finish to write {n_words} tokens, time costs {time.time() - start_time:.2f}')
+        return path, n_words
 
-    def train(self):
-        self._build_vocab()
+    def _vocab_freq(self):
+        # A node starts its walks and is then visited in proportion to its degree.
+        deg = self._visit_weights()
+        n_walks = len(self.iter_path)
+        n_visits = n_walks * self.walk_length
+        freq = 1 + np.rint(n_visits * deg / max(deg.sum(), 1)).astype(np.int64)
+        # Nodes of types that never appear in a walk only hold a placeholder slot.
+        freq[~self._emitted_mask()] = 1
+        key_type = str if self.corpus_mode == 'corpus_file' else int
+        return {key_type(i): f for i, f in enumerate(freq.tolist())}
+
+    def _build_vocab(self, corpus_file=None):
         if self.verbose:
-            logger.info('Start to train model')
+            logger.info('Start to build vocab')
         start_time = time.time()
-        self.model.train(
-            tqdm.tqdm(self.iter_path, disable=not self.verbose),
-            total_examples=len(self.iter_path),
-            epochs=self.epochs,
-            queue_factor=10,
-            callbacks=[Callback(verbose=self.verbose)]
-        )
+        if self.vocab == 'graph':
+            self.model.build_vocab_from_freq(self._vocab_freq(), corpus_count=len(self.iter_path))
+        elif corpus_file is None:
+            self.model.build_vocab(corpus_iterable=tqdm.tqdm(self.iter_path, disable=not self.verbose))
+        else:
+            self.model.build_vocab(corpus_file=corpus_file)
         if self.verbose:
-            logger.info(f'Finish to train model, time costs {time.time() - start_time:.2f}')
+            logger.info(f'Finish to build vocab, time costs {time.time() - start_time:.2f}')
+
+    def _fit(self, epochs, build_vocab=True, start_epoch=0, last_total_loss=0, start_alpha=None):
+        callback = Callback(
+            epoch=start_epoch,
+            last_total_loss=last_total_loss,
+            checkpoint_dir=self.checkpoint_dir,
+            checkpoint_every=self.checkpoint_every,
+            keep_checkpoints=self.keep_checkpoints,
+            walker=self.iter_path,
+            verbose=self.verbose
+        )
+        callbacks = [callback]
+        corpus_file, n_words = self._write_corpus() if self.corpus_mode == 'corpus_file' else (None, 0)
+        try:
+            if build_vocab:
+                self._build_vocab(corpus_file)
+            if self.early_stopping is not None:
+                callbacks.append(self.early_stopping.attach(self.g, self._node_index()))
+            if self.verbose:
+                logger.info('Start to train model')
+            start_time = time.time()
+            if corpus_file is None:
+                self.model.train(
+                    tqdm.tqdm(self.iter_path, disable=not self.verbose),
+                    total_examples=len(self.iter_path),
+                    epochs=epochs,
+                    start_alpha=start_alpha,
+                    queue_factor=10,
+                    callbacks=callbacks
+                )
+            else:
+                # corpus_file workers read the file themselves without holding the GIL.
+                self.model.train(
+                    corpus_file=corpus_file,
+                    total_words=n_words,
+                    epochs=epochs,
+                    start_alpha=start_alpha,
+                    callbacks=callbacks
+                )
+            if self.verbose:
+                logger.info(f'Finish to train model, time costs {time.time() - start_time:.2f}')
+        except _StopTraining:
+            # Raised between epochs, after gensim has joined the epoch's workers.
+            if self.verbose:
+                logger.info(f'Stop training early after epoch {callback.epoch}')
+        finally:
+            self.iter_path.close()
+            if corpus_file is not None and self.corpus_path is None:
+                os.remove(corpus_file)
         return self
 
-    def get_embedding(self):
-        emb = np.zeros((self.g.num_nodes(), self.emb_size))
-        for i in range(self.g.num_nodes()):
-            emb[i, :] = self.model.wv[i]
-        return emb
+    def train(self, resume_from: str = None):
+        if resume_from is None:
+            return self._fit(self.epochs)
 
-    def save_embedding(self, path):
-        emb = self.get_embedding()
+        checkpoints = Callback.list_checkpoints(resume_from)
+        assert len(checkpoints) > 0, f'No complete checkpoint in {resume_from}'
+        path = checkpoints[-1]
+        with open(os.path.join(path, 'state.json'), encoding='utf-8') as f:
+            state = json.load(f)
+        # Continue the linear learning rate decay of the full run from the completed epochs.
+        alpha, min_alpha = self.model.alpha, self.model.min_alpha
+        start_alpha = alpha - (alpha - min_alpha) * state['epoch'] / self.epochs
+        self.load_model(os.path.join(path, 'model'))
+        # A corpus file holds a single walk pass, which is rewritten from the same pass on resume.
+        self.iter_path._epoch = state['walk_epoch'] - int(self.corpus_mode == 'corpus_file')
+        if self.verbose:
+            logger.info(f'Resume from {path} after epoch {state["epoch"]}')
+        if state['epoch'] >= self.epochs:
+            return self
+        return self._fit(self.epochs - state['epoch'], build_vocab=False, start_epoch=state['epoch'],
+                         last_total_loss=state['last_total_loss'], start_alpha=start_alpha)
 
-        check_and_mkdir(path)
-        with open(path, 'wb') as f:
-            pickle.dump(emb, f)
-        return self
+    def refresh(self, prev_model_path: str, prev_g: dgl.DGLGraph, hops: int = 1, epochs: int = 1):
+        # Warm start from the model trained on prev_g and only walk from the part of the graph that moved.
+        # Vocab keys are dgl ids, which are renumbered with every graph, so the vocabulary is rebuilt on
+        # the new ids and the previous vectors are carried over through ndata['nid'].
+        nodes = changed_nodes(prev_g, self.g)
+        if hops > 0 and len(nodes) > 0:
+            sg, _ = dgl.khop_out_subgraph(self.g, torch.from_numpy(nodes), k=hops)
+            nodes = np.sort(sg.ndata[dgl.NID].numpy())
+        if self.verbose:
+            logger.info(f'{len(nodes)} of {self.g.num_nodes()} nodes are new or changed within {hops} hops')
+
+        self.load_model(prev_model_path)
+        prev_model = self.model
+        prev_index = self._key_index(prev_model.wv, prev_g.num_nodes())
+
+        self.iter_path = self._init_walker(start_nodes=nodes)
+        self.vocab = 'graph'
+        self.model = self._init_model()
+        self._build_vocab()
+        rows = map_nid(self.g.ndata['nid'].numpy(), prev_g.ndata['nid'].numpy())
+        prev_rows = np.where(rows >= 0, prev_index[rows], -1)
+        kept = np.flatnonzero(prev_rows >= 0)
+        index = self._key_index(self.model.wv, self.g.num_nodes())[kept]
+        self.model.wv.vectors[index] = prev_model.wv.vectors[prev_rows[kept]]
+        if self.loss == 'ns' and prev_model.negative > 0:
+            # Output vectors are per node under negative sampling, the hs huffman tree is rebuilt instead.
+            self.model.syn1neg[index] = prev_model.syn1neg[prev_rows[kept]]
+        if self.verbose:
+            logger.info(f'Warm start {len(kept)} nodes from {prev_model_path}')
+
+        if len(nodes) == 0:
+            return self
+        return self._fit(epochs, build_vocab=False)
+
+    @staticmethod
+    def _key_index(wv, n_nodes):
+        # Models trained from a corpus file are keyed by the string form of the node id.
+        str_keys = len(wv.index_to_key) > 0 and isinstance(wv.index_to_key[0], str)
+        keys = map(str, range(n_nodes)) if str_keys else range(n_nodes)
+        return np.fromiter((wv.key_to_index.get(k, -1) for k in keys), dtype=np.int64, count=n_nodes)
+
+    def _node_index(self):
+        index = self._key_index(self.model.wv, self.g.num_nodes())
+        index[~self._emitted_mask()] = -1
+        return index
+
+    def get_embedding(self, dtype: type = np.float32, out: [np.ndarray, str, None] = None,
+                      return_missing: bool = False, block_size: int = 2 ** 16):
+        emb, missing = self._export_embedding(self.model.wv.vectors, index=self._node_index(), dtype=dtype,
+                                              out=out, block_size=block_size)
+        if len(missing) > 0:
+            logger.warning(f'{len(missing)} nodes are missing from the vocabulary, their embeddings are zeros.')
+        return (emb, missing) if return_missing else emb
 
     def save_model(self, path):
         check_and_mkdir(path)
@@ -1,8 +1,7 @@
 import logging
 import dgl
 
-from ge.models.utils.walkers import RandomWalk
-from ge.models.deepwalk import DeepWalk
+from ge.models.deepwalk import DeepWalk, EarlyStopping
 
 
 logger = logging.getLogger('ge')
@@ -11,17 +10,26 @@ logger = logging.getLogger('ge')
 class Node2VecWalk(DeepWalk):
     def __init__(self, g: dgl.DGLGraph, walk_length: int = 200, window: int = 10, emb_size: int = 64,
                  p: float = 1, q: float = 1,
-                 batch_size: int = 1e7, epochs: int = 3, n_jobs: int = -1, verbose: bool = True):
-        super(Node2VecWalk, self).__init__(
-            g=g, walk_length=walk_length, window=window, emb_size=emb_size, batch_size=batch_size,
-            epochs=epochs, n_jobs=n_jobs, verbose=verbose
-        )
+                 batch_size: int = None, memory_budget: int = 2 ** 30, epochs: int = 3,
+                 n_jobs: int = -1, walk_jobs: int = 1,
+                 seed: int = None, cache_dir: str = None, graph_id: str = None,
+                 corpus_mode: str = 'iterable', corpus_path: str = None, vocab: str = 'corpus',
+                 loss: str = 'hs', negative: int = 5,
+                 node_type: list = None, type_mapping: dict = None,
+                 num_walks_per_node: int = 1, weight: str = None, start_sampling: str = 'uniform',
+                 checkpoint_dir: str = None, checkpoint_every: int = 1, keep_checkpoints: int = 1,
+                 early_stopping: EarlyStopping = None, verbose: bool = True):
         self.p = p
         self.q = q
-        self.iter_path = RandomWalk(
-            g=self.g,
-            walk_length=self.walk_length,
-            p=self.p,
-            q=self.q,
-            batch_size=self.batch_size
+        super(Node2VecWalk, self).__init__(
+            g=g, walk_length=walk_length, window=window, emb_size=emb_size, batch_size=batch_size,
+            memory_budget=memory_budget, epochs=epochs, n_jobs=n_jobs, walk_jobs=walk_jobs, seed=seed,
+            cache_dir=cache_dir, graph_id=graph_id, corpus_mode=corpus_mode, corpus_path=corpus_path,
+            vocab=vocab, loss=loss, negative=negative, node_type=node_type, type_mapping=type_mapping,
+            num_walks_per_node=num_walks_per_node, weight=weight, start_sampling=start_sampling,
+            checkpoint_dir=checkpoint_dir, checkpoint_every=checkpoint_every, keep_checkpoints=keep_checkpoints,
+            early_stopping=early_stopping, verbose=verbose
         )
+
+    def _init_walker(self, **kwargs):
+        return super(Node2VecWalk, self)._init_walker(p=self.p, q=self.q, **kwargs)
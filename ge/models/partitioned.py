@@ -0,0 +1,189 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing as mp
+import numpy as np
+import dgl
+import torch
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+from ge.models._base import _Model
+from ge.models.deepwalk import DeepWalk
+from ge.utils import check_and_mkdir, csr_adj
+
+logger = logging.getLogger('ge')
+
+
+def _train_partition(model_cls, graph_path, emb_path, model_kwargs):
+    # Runs in its own process, which only ever loads its partition.
+    sg = dgl.load_graphs(graph_path)[0][0]
+    model = model_cls(sg, **model_kwargs).train()
+    model.get_embedding(out=emb_path)
+    return emb_path
+
+
+def _label_propagation(indptr: np.ndarray, indices: np.ndarray, n_iter: int, seed: int) -> np.ndarray:
+    # Every node takes the most frequent label among its neighbours, ties broken at random. Only a random
+    # half of the nodes moves per round, otherwise the two sides of a bipartite graph swap labels forever.
+    rng = np.random.default_rng(seed)
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr))
+    label = np.arange(n, dtype=np.int64)
+    for _ in range(n_iter):
+        key, count = np.unique(rows * n + label[indices], return_counts=True)
+        node, cand = key // n, key % n
+        order = np.lexsort((-(count + rng.random(len(count)) / 2), node))
+        first = order[np.r_[True, node[order][1:] != node[order][:-1]]]
+        best = label.copy()
+        best[node[first]] = cand[first]
+        move = (rng.random(n) < 0.5) & (best != label)
+        if not move.any():
+            break
+        label[move] = best[move]
+    return label
+
+
+def degree_partition(g: dgl.DGLGraph, n_parts: int, n_iter: int = 50, seed: int = 0) -> torch.Tensor:
+    # Ranges holding about the same number of edges each, cut from an order that keeps neighbours close:
+    # nodes are grouped by label propagation community, and breadth-first (reverse Cuthill-McKee) within
+    # them. Node ids carry no locality, accounts typically come before assets, so cutting the id range
+    # would leave every partition a set of stars.
+    indptr, indices, _ = csr_adj(g)
+    indptr, indices = indptr.numpy(), indices.numpy()
+    adj = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(g.num_nodes(), g.num_nodes()))
+    bfs_rank = np.empty(g.num_nodes(), dtype=np.int64)
+    bfs_rank[reverse_cuthill_mckee(adj, symmetric_mode=False)] = np.arange(g.num_nodes())
+    order = torch.from_numpy(np.lexsort((bfs_rank, _label_propagation(indptr, indices, n_iter, seed))))
+    cum_deg = torch.cumsum(g.in_degrees()[order] + 1, 0).double()
+    assignment = torch.empty(g.num_nodes(), dtype=torch.int64)
+    assignment[order] = torch.clamp((cum_deg - 1) * n_parts // cum_deg[-1], max=n_parts - 1).long()
+    return assignment
+
+
+def procrustes(source: np.ndarray, target: np.ndarray) -> np.ndarray:
+    # Orthogonal map R minimising ||source @ R - target||, from the SVD of source^T target.
+    u, _, vt = np.linalg.svd(source.T.astype(np.float64) @ target.astype(np.float64))
+    return (u @ vt).astype(np.float32)
+
+
+class PartitionedModel(_Model):
+    def __init__(self, g: dgl.DGLGraph, n_parts: int, model_cls: type = DeepWalk, partition: str = 'metis',
+                 halo_hops: int = 1, n_procs: int = None, n_jobs: int = -1, work_dir: str = None,
+                 verbose: bool = True, **model_kwargs):
+        assert partition in ('metis', 'degree'), f'Unknown partition method {partition}'
+        self.g = g
+        self.n_parts = n_parts
+        self.model_cls = model_cls
+        self.partition = partition
+        self.halo_hops = halo_hops
+        self.n_procs = min(n_parts, n_procs or mp.cpu_count())
+        self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count()
+        self.work_dir = work_dir
+        self.verbose = verbose
+        self.model_kwargs = model_kwargs
+        self.assignment = None
+        self.emb = None
+
+    def _assign(self):
+        if self.partition == 'metis':
+            return dgl.metis_partition_assignment(self.g, self.n_parts)
+        return degree_partition(self.g, self.n_parts)
+
+    def _partition_nodes(self, part):
+        # The partition's own nodes plus a halo of their neighbours, shared with the adjacent partitions.
+        core = torch.nonzero(self.assignment == part, as_tuple=True)[0]
+        if self.halo_hops == 0 or len(core) == 0:
+            return core, core
+        sg, _ = dgl.khop_out_subgraph(self.g, core, k=self.halo_hops)
+        return core, torch.sort(sg.ndata[dgl.NID])[0]
+
+    def _write_partitions(self, work_dir):
+        parts = list()
+        for part in range(self.n_parts):
+            core, nodes = self._partition_nodes(part)
+            sg = dgl.node_subgraph(self.g, nodes)
+            graph_path = os.path.join(work_dir, f'part_{part}.bin')
+            dgl.save_graphs(graph_path, [sg])
+            parts.append((core.numpy(), nodes.numpy(), graph_path, os.path.join(work_dir, f'emb_{part}.npy')))
+            del sg
+        return parts
+
+    def _merge(self, parts):
+        # Partitions live in their own rotated spaces. Each one is rotated onto the nodes it shares
+        # with the partitions already placed, visiting the best connected partition first.
+        emb = np.zeros((self.g.num_nodes(), self.emb_size), dtype=np.float32)
+        placed = np.zeros(self.g.num_nodes(), dtype=bool)
+        remaining = list(range(len(parts)))
+        while remaining:
+            overlap = [placed[parts[i][1]].sum() for i in remaining]
+            i = remaining.pop(int(np.argmax(overlap)))
+            core, nodes, _, emb_path = parts[i]
+            part_emb = np.load(emb_path)
+            shared = placed[nodes] & (np.abs(part_emb).sum(axis=1) > 0) & (np.abs(emb[nodes]).sum(axis=1) > 0)
+            rotation = procrustes(part_emb[shared], emb[nodes[shared]]) if shared.sum() >= self.emb_size \
+                else np.eye(self.emb_size, dtype=np.float32)
+            local = np.searchsorted(nodes, core)
+            emb[core] = part_emb[local] @ rotation
+            placed[core] = True
+            if self.verbose:
+                logger.info(f'Merge partition {i} of {len(core)} nodes on {int(shared.sum())} shared nodes')
+        return emb
+
+    @property
+    def emb_size(self):
+        return self.model_kwargs.get('emb_size', 64)
+
+    def train(self):
+        start_time = time.time()
+        work_dir = self.work_dir or tempfile.mkdtemp()
+        check_and_mkdir(os.path.join(work_dir, 'part'))
+        try:
+            self.assignment = self._assign()
+            parts = self._write_partitions(work_dir)
+            if self.verbose:
+                logger.info(f'Split graph into {self.n_parts} partitions, time costs {time.time() - start_time:.2f}')
+
+            # Every process trains one partition at a time and the cores are split between them.
+            model_kwargs = dict(self.model_kwargs, n_jobs=max(1, self.n_jobs // self.n_procs),
+                                verbose=self.verbose)
+            ctx = mp.get_context('spawn')
+            with ctx.Pool(self.n_procs, maxtasksperchild=1) as pool:
+                results = list()
+                for part, (_, _, graph_path, emb_path) in enumerate(parts):
+                    kwargs = dict(model_kwargs)
+                    if kwargs.get('graph_id') is not None:
+                        # Walk caches are keyed by graph_id, which has to name the partition.
+                        kwargs['graph_id'] = f"{kwargs['graph_id']}_part{part}_of{self.n_parts}"
+                    results.append(pool.apply_async(_train_partition, (self.model_cls, graph_path, emb_path, kwargs)))
+                for r in results:
+                    r.get()
+                pool.close()
+                pool.join()
+            self.emb = self._merge(parts)
+        finally:
+            if self.work_dir is None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        if self.verbose:
+            logger.info(f'Finish to train partitioned model, time costs {time.time() - start_time:.2f}')
+        return self
+
+    def get_embedding(self, dtype: type = np.float32, out: [np.ndarray, str, None] = None,
+                      return_missing: bool = False, block_size: int = 2 ** 16):
+        missing = np.flatnonzero(np.abs(self.emb).sum(axis=1) == 0)
+        emb, missing = self._export_embedding(self.emb, missing=missing, dtype=dtype, out=out, block_size=block_size)
+        return (emb, missing) if return_missing else emb
+
+    def save_model(self, path):
+        check_and_mkdir(path)
+
+        with open(path, 'wb') as f:
+            np.savez(f, emb=self.emb, assignment=self.assignment.numpy())
+        return self
+
+    def load_model(self, path):
+        state = np.load(path)
+        self.emb = state['emb']
+        self.assignment = torch.from_numpy(state['assignment'])
@@ -0,0 +1,152 @@
+import time
+import logging
+import multiprocessing as mp
+import numpy as np
+import dgl
+import torch
+import tqdm
+
+from ge.models._base import _WalkModel
+from ge.models.utils.walkers import WalkChunk
+from ge.utils import check_and_mkdir, torch_threads
+
+logger = logging.getLogger('ge')
+
+
+def _context_pairs(chunk: WalkChunk, window: int, rng: np.random.Generator):
+    # Dynamic window as in word2vec: every center draws its own reach in [1, window].
+    values = np.asarray(chunk.values, dtype=np.int64)
+    walk_index = chunk.walk_index
+    reach = rng.integers(1, window + 1, size=len(values))
+    centers, contexts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for offset in range(1, min(window, len(values) - 1) + 1):
+        same = walk_index[:-offset] == walk_index[offset:]
+        left = same & (reach[:-offset] >= offset)
+        right = same & (reach[offset:] >= offset)
+        centers += [values[:-offset][left], values[offset:][right]]
+        contexts += [values[offset:][left], values[:-offset][right]]
+    return np.concatenate(centers), np.concatenate(contexts)
+
+
+class SkipGram(_WalkModel):
+    def __init__(self, g: dgl.DGLGraph, walk_length: int = 200, window: int = 10, emb_size: int = 64,
+                 negative: int = 5, lr: float = 0.025, min_lr: float = 1e-4, pair_batch_size: int = 2 ** 14,
+                 batch_size: int = None, memory_budget: int = 2 ** 30, epochs: int = 3,
+                 n_jobs: int = -1, walk_jobs: int = 1,
+                 seed: int = None, cache_dir: str = None, graph_id: str = None,
+                 node_type: list = None, metapath: list = None, type_mapping: dict = None,
+                 num_walks_per_node: int = 1, weight: str = None, start_sampling: str = 'uniform',
+                 p: float = 1, q: float = 1, verbose: bool = True):
+        self.g = g
+        self.walk_length = walk_length
+        self.window = window
+        self.emb_size = emb_size
+        self.negative = negative
+        self.lr = lr
+        self.min_lr = min_lr
+        self.pair_batch_size = pair_batch_size
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.epochs = epochs
+        self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count() - 1
+        self.walk_jobs = walk_jobs if walk_jobs != -1 else mp.cpu_count() - 1
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.graph_id = graph_id
+        self.node_type = node_type
+        self.metapath = metapath
+        self.type_mapping = type_mapping
+        self.num_walks_per_node = num_walks_per_node
+        self.weight = weight
+        self.start_sampling = start_sampling
+        self.p = p
+        self.q = q
+        self.verbose = verbose
+        self.iter_path = self._init_walker(p=self.p, q=self.q)
+
+        n_nodes = self.g.num_nodes()
+        generator = torch.Generator().manual_seed(self.seed if self.seed is not None else 1)
+        # word2vec initialisation: small random input vectors and zero output vectors.
+        self.w_in = (torch.rand(n_nodes, self.emb_size, generator=generator) - 0.5) / self.emb_size
+        self.w_out = torch.zeros(n_nodes, self.emb_size)
+        self.loss_history = list()
+
+    def _noise_cdf(self):
+        # Walks visit nodes in proportion to their degree, raised to 3/4 like the word2vec unigram table.
+        noise = np.power(self._visit_weights(), 0.75) * self._emitted_mask()
+        cdf = np.cumsum(noise)
+        return torch.from_numpy(cdf / cdf[-1])
+
+    def _step(self, center, context, lr, noise_cdf, generator):
+        n_pairs = len(center)
+        u = torch.rand(n_pairs * self.negative, generator=generator, dtype=noise_cdf.dtype)
+        neg = torch.searchsorted(noise_cdf, u).clamp_(max=len(noise_cdf) - 1).view(n_pairs, self.negative)
+        targets = torch.cat([context[:, None], neg], dim=1)
+
+        vec_in = self.w_in[center]
+        vec_out = self.w_out[targets]
+        score = torch.bmm(vec_out, vec_in[:, :, None]).squeeze(2)
+        label = torch.zeros_like(score)
+        label[:, 0] = 1
+        coef = (label - torch.sigmoid(score)) * lr
+
+        # Updates of a row repeated in the batch add up, as they would in sequential word2vec.
+        self.w_in.index_add_(0, center, torch.bmm(coef[:, None, :], vec_out).squeeze(1))
+        grad_out = (coef[:, :, None] * vec_in[:, None, :]).reshape(-1, self.emb_size)
+        self.w_out.index_add_(0, targets.reshape(-1), grad_out)
+        loss = torch.nn.functional.logsigmoid(score[:, 0]) + torch.nn.functional.logsigmoid(-score[:, 1:]).sum(1)
+        return -loss.sum().item()
+
+    def train(self):
+        if self.verbose:
+            logger.info('Start to train model')
+        start_time = time.time()
+        rng = np.random.default_rng(self.seed)
+        generator = torch.Generator().manual_seed(self.seed if self.seed is not None else 1)
+        noise_cdf = self._noise_cdf()
+        total_walks = max(1, len(self.iter_path) * self.epochs)
+        done_walks = 0
+
+        with torch_threads(self.n_jobs):
+            for epoch in range(self.epochs):
+                epoch_time = time.time()
+                epoch_loss, epoch_pairs = 0., 0
+                for chunk in tqdm.tqdm(self.iter_path.iter_chunks(), disable=not self.verbose):
+                    centers, contexts = _context_pairs(chunk, self.window, rng)
+                    order = rng.permutation(len(centers))
+                    for start in range(0, len(order), self.pair_batch_size):
+                        # Linear decay as in word2vec, by the share of walks consumed so far.
+                        progress = (done_walks + len(chunk) * start / len(order)) / total_walks
+                        lr = max(self.min_lr, self.lr * (1 - progress))
+                        idx = order[start: start + self.pair_batch_size]
+                        epoch_loss += self._step(torch.from_numpy(centers[idx]), torch.from_numpy(contexts[idx]),
+                                                 lr, noise_cdf, generator)
+                    epoch_pairs += len(centers)
+                    done_walks += len(chunk)
+                self.loss_history.append(epoch_loss / max(epoch_pairs, 1))
+                if self.verbose:
+                    logger.info(f'Finish epoch {epoch}. Time cost {time.time() - epoch_time: .2f}')
+                    logger.info('Loss after epoch {}: {}'.format(epoch, self.loss_history[-1]))
+        self.iter_path.close()
+        if self.verbose:
+            logger.info(f'Finish to train model, time costs {time.time() - start_time:.2f}')
+        return self
+
+    def get_embedding(self, dtype: type = np.float32, out: [np.ndarray, str, None] = None,
+                      return_missing: bool = False, block_size: int = 2 ** 16):
+        # Nodes of types the walks never emit keep their untrained vectors, so they are zeroed.
+        emb, missing = self._export_embedding(self.w_in.numpy(), missing=np.flatnonzero(~self._emitted_mask()),
+                                              dtype=dtype, out=out, block_size=block_size)
+        return (emb, missing) if return_missing else emb
+
+    def save_model(self, path):
+        check_and_mkdir(path)
+
+        torch.save({'w_in': self.w_in, 'w_out': self.w_out, 'loss_history': self.loss_history}, path)
+        return self
+
+    def load_model(self, path):
+        state = torch.load(path)
+        self.w_in = state['w_in']
+        self.w_out = state['w_out']
+        self.loss_history = state['loss_history']
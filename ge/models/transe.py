@@ -0,0 +1,163 @@
+import time
+import logging
+import multiprocessing as mp
+import numpy as np
+import dgl
+import torch
+import tqdm
+
+from ge.models._base import _Model
+from ge.utils import check_and_mkdir, torch_threads
+
+logger = logging.getLogger('ge')
+
+
+class TransE(_Model):
+    def __init__(self, g: dgl.DGLGraph, emb_size: int = 64, margin: float = 1., p_norm: int = 1,
+                 negative: int = 4, lr: float = 0.05, batch_size: int = 2 ** 14, block_size: int = 2 ** 22,
+                 epochs: int = 3, src_type: int = 0, n_jobs: int = -1, seed: int = None, verbose: bool = True):
+        self.g = g
+        self.emb_size = emb_size
+        self.margin = margin
+        self.p_norm = p_norm
+        self.negative = negative
+        self.lr = lr
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.epochs = epochs
+        self.src_type = src_type
+        self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count() - 1
+        self.seed = seed
+        self.verbose = verbose
+
+        # Each asset type is a relation: acct --tid[asset]--> asset. Untyped graphs have a single relation.
+        src, dst = self.g.edges()
+        if 'tid' in self.g.ndata:
+            tid = self.g.ndata['tid']
+            self.eids = torch.nonzero((tid[src] == self.src_type) & (tid[dst] != self.src_type), as_tuple=True)[0]
+            self.n_relations = int(tid.max()) + 1
+        else:
+            self.eids = torch.arange(self.g.num_edges())
+            self.n_relations = 1
+
+        generator = torch.Generator().manual_seed(self.seed if self.seed is not None else 1)
+        bound = 6 / np.sqrt(self.emb_size)
+        self.entity = torch.nn.Embedding(self.g.num_nodes(), self.emb_size, sparse=True)
+        self.relation = torch.nn.Embedding(self.n_relations, self.emb_size, sparse=True)
+        with torch.no_grad():
+            self.entity.weight.uniform_(-bound, bound, generator=generator)
+            self.relation.weight.uniform_(-bound, bound, generator=generator)
+            self.relation.weight.div_(self.relation.weight.norm(dim=1, keepdim=True))
+        self.loss_history = list()
+
+    def _type_index(self):
+        # Nodes grouped by type, so corrupted entities are drawn from the type they replace.
+        tid = self.g.ndata['tid'] if 'tid' in self.g.ndata else torch.zeros(self.g.num_nodes(), dtype=torch.int64)
+        order = torch.argsort(tid, stable=True)
+        offset = torch.zeros(int(tid.max()) + 2, dtype=torch.int64)
+        offset[1:] = torch.cumsum(torch.bincount(tid, minlength=int(tid.max()) + 1), 0)
+        return tid, order, offset
+
+    def _corrupt(self, nodes, tid, order, offset, generator):
+        start = offset[tid[nodes]]
+        size = offset[tid[nodes] + 1] - start
+        pick = (torch.rand(len(nodes), generator=generator) * size).long()
+        return order[start + pick]
+
+    def _batches(self, generator):
+        # Edges are streamed block by block: blocks are visited in random order and shuffled inside, so an
+        # epoch never builds a permutation or a triple tensor of the whole graph.
+        n_edges = len(self.eids)
+        for b in torch.randperm(-(-n_edges // self.block_size), generator=generator).tolist():
+            block = self.eids[b * self.block_size: (b + 1) * self.block_size]
+            block = block[torch.randperm(len(block), generator=generator)]
+            for start in range(0, len(block), self.batch_size):
+                yield block[start: start + self.batch_size]
+
+    def _distance(self, head, rel, tail):
+        return torch.norm(head + rel - tail, p=self.p_norm, dim=-1)
+
+    def _step(self, eids, type_index, optimizer, generator):
+        tid, order, offset = type_index
+        head, tail = self.g.find_edges(eids)
+        rel = tid[tail] if 'tid' in self.g.ndata else torch.zeros_like(tail)
+
+        # Each positive gets `negative` corruptions, replacing the head or the tail with equal chance.
+        n = len(eids) * self.negative
+        neg_head, neg_tail = head.repeat(self.negative), tail.repeat(self.negative)
+        replace_head = torch.rand(n, generator=generator) < 0.5
+        neg_head = torch.where(replace_head, self._corrupt(neg_head, tid, order, offset, generator), neg_head)
+        neg_tail = torch.where(replace_head, neg_tail, self._corrupt(neg_tail, tid, order, offset, generator))
+
+        r = self.relation(rel)
+        pos = self._distance(self.entity(head), r, self.entity(tail))
+        neg = self._distance(self.entity(neg_head), r.repeat(self.negative, 1), self.entity(neg_tail))
+        loss = torch.relu(self.margin + pos.repeat(self.negative) - neg).mean()
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        with torch.no_grad():
+            # Entities touched by the batch are kept on the unit sphere.
+            touched = torch.unique(torch.cat([head, tail, neg_head, neg_tail]))
+            w = self.entity.weight[touched]
+            self.entity.weight[touched] = w / w.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        return loss.item()
+
+    def train(self):
+        if self.verbose:
+            logger.info('Start to train model')
+        start_time = time.time()
+        generator = torch.Generator().manual_seed(self.seed if self.seed is not None else 1)
+        type_index = self._type_index()
+        optimizer = torch.optim.Adagrad(list(self.entity.parameters()) + list(self.relation.parameters()), lr=self.lr)
+
+        with torch_threads(self.n_jobs):
+            for epoch in range(self.epochs):
+                epoch_time = time.time()
+                epoch_loss, n_batches = 0., 0
+                n_total = -(-len(self.eids) // self.batch_size)
+                for eids in tqdm.tqdm(self._batches(generator), total=n_total, disable=not self.verbose):
+                    epoch_loss += self._step(eids, type_index, optimizer, generator)
+                    n_batches += 1
+                self.loss_history.append(epoch_loss / max(n_batches, 1))
+                if self.verbose:
+                    logger.info(f'Finish epoch {epoch}. Time cost {time.time() - epoch_time: .2f}')
+                    logger.info('Loss after epoch {}: {}'.format(epoch, self.loss_history[-1]))
+        if self.verbose:
+            logger.info(f'Finish to train model, time costs {time.time() - start_time:.2f}')
+        return self
+
+    def get_relation_embedding(self, dtype: type = np.float32):
+        return self.relation.weight.detach().numpy().astype(dtype)
+
+    def get_embedding(self, dtype: type = np.float32, out: [np.ndarray, str, None] = None,
+                      return_missing: bool = False, block_size: int = 2 ** 16):
+        # Nodes without a typed acct->asset edge never get trained, so they are zeroed.
+        src, dst = self.g.find_edges(self.eids)
+        seen = torch.zeros(self.g.num_nodes(), dtype=torch.bool)
+        seen[src] = True
+        seen[dst] = True
+        missing = np.flatnonzero(~seen.numpy())
+        if len(missing) > 0:
+            logger.warning(f'{len(missing)} nodes have no typed edge, their embeddings are zeros.')
+
+        emb, missing = self._export_embedding(self.entity.weight.detach().numpy(), missing=missing, dtype=dtype,
+                                              out=out, block_size=block_size)
+        return (emb, missing) if return_missing else emb
+
+    def save_model(self, path):
+        check_and_mkdir(path)
+
+        torch.save({
+            'entity': self.entity.state_dict(),
+            'relation': self.relation.state_dict(),
+            'loss_history': self.loss_history
+        }, path)
+        return self
+
+    def load_model(self, path):
+        state = torch.load(path)
+        self.entity.load_state_dict(state['entity'])
+        self.relation.load_state_dict(state['relation'])
+        self.loss_history = state['loss_history']
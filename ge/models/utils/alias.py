@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def build_alias_table(indptr: np.ndarray, weights: np.ndarray, eps: float = 1e-12):
+    # Edge k keeps itself with probability prob[k] and otherwise jumps to edge alias[k] of the same row.
+    # All rows are built together: each round pairs every under-full bucket with an over-full one through
+    # the running sums of deficit and excess, only drained over-full buckets go to the next round.
+    indptr = np.asarray(indptr, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    n_edges = len(weights)
+    deg = np.diff(indptr)
+    row = np.repeat(np.arange(len(deg)), deg)
+    row_sum = np.bincount(row, weights=weights, minlength=len(deg))
+
+    q = np.ones(n_edges, dtype=np.float64)
+    weighted = row_sum[row] > 0
+    q[weighted] = weights[weighted] * deg[row[weighted]] / row_sum[row[weighted]]
+    prob = np.ones(n_edges, dtype=np.float32)
+    alias = np.arange(n_edges, dtype=np.int64)
+
+    pending = np.arange(n_edges, dtype=np.int64)
+    while len(pending) > 0:
+        is_small = q[pending] < 1 - eps
+        small, large = pending[is_small], pending[~is_small]
+        if len(small) == 0:
+            break
+        r_small, r_large = row[small], row[large]
+        first = np.searchsorted(r_large, r_small, side='left')
+        last = np.searchsorted(r_large, r_small, side='right')
+        # Without an over-full bucket left in the row the deficit is rounding error.
+        paired = last > first
+        prob[small[~paired]] = 1
+        small, r_small, first, last = small[paired], r_small[paired], first[paired], last[paired]
+
+        deficit = 1 - q[small]
+        cum_deficit = np.cumsum(deficit)
+        row_first = np.searchsorted(r_small, r_small, side='left')
+        offset = (cum_deficit - deficit) - (cum_deficit[row_first] - deficit[row_first])
+
+        excess = q[large] - 1
+        cum_excess = np.cumsum(excess)
+        target = np.searchsorted(cum_excess, cum_excess[first] - excess[first] + offset, side='right')
+        target = np.clip(target, first, last - 1)
+
+        prob[small] = q[small]
+        alias[small] = large[target]
+        q[large] = np.maximum(q[large] - np.bincount(target, weights=deficit, minlength=len(large)), 0)
+        pending = large
+    return prob, alias
+
+
+def alias_walk(indptr: np.ndarray, indices: np.ndarray, prob: np.ndarray, alias: np.ndarray,
+               nodes: np.ndarray, walk_length: int, rng: np.random.Generator) -> np.ndarray:
+    walks = np.full((len(nodes), walk_length + 1), -1, dtype=np.int64)
+    walks[:, 0] = cur = np.asarray(nodes, dtype=np.int64)
+    alive = np.arange(len(nodes))
+    for t in range(walk_length):
+        start = indptr[cur[alive]]
+        deg = indptr[cur[alive] + 1] - start
+        ok = deg > 0
+        alive, start, deg = alive[ok], start[ok], deg[ok]
+        if len(alive) == 0:
+            break
+        k = start + (rng.random(len(alive)) * deg).astype(np.int64)
+        if prob is not None:
+            k = np.where(rng.random(len(alive)) < prob[k], k, alias[k])
+        nxt = indices[k]
+        cur[alive] = nxt
+        walks[alive, t + 1] = nxt
+    return walks
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from ge.utils import check_and_mkdir, map_nid
+
+
+def _unit(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _assign(vectors: torch.Tensor, centroids: torch.Tensor, block_size: int) -> torch.Tensor:
+    return torch.cat([torch.argmax(vectors[start: start + block_size] @ centroids.T, dim=1)
+                      for start in range(0, len(vectors), block_size)])
+
+
+class IVFIndex:
+    # Inverted file index over L2-normalized vectors: spherical k-means splits the nodes into n_lists lists,
+    # stored contiguously, and a query only scans the n_probe lists closest to it.
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, rows: np.ndarray, vectors: np.ndarray,
+                 nid: np.ndarray = None):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.nid = nid
+        self._position = None
+
+    @classmethod
+    def build(cls, emb: np.ndarray, n_lists: int = None, n_iter: int = 10, n_train: int = 2 ** 16,
+              nid: np.ndarray = None, seed: int = 0, block_size: int = 2 ** 16):
+        # emb is an embedding matrix, as returned by DeepWalk.get_embedding, or an EmbeddingStore.
+        get = emb.get if hasattr(emb, 'get') else emb.__getitem__
+        rng = np.random.default_rng(seed)
+        n_rows = emb.shape[0]
+        n_lists = min(n_rows, n_lists or max(1, int(4 * np.sqrt(n_rows))))
+
+        # k-means is trained on a sample, then every vector goes to its closest centroid.
+        sample = np.sort(rng.choice(n_rows, min(n_train, n_rows), replace=False))
+        train = torch.from_numpy(_unit(get(sample)))
+        centroids = train[torch.from_numpy(rng.choice(len(train), n_lists, replace=False))]
+        for _ in range(n_iter):
+            assign = _assign(train, centroids, block_size)
+            sums = torch.zeros_like(centroids).index_add_(0, assign, train)
+            empty = torch.bincount(assign, minlength=n_lists) == 0
+            # Empty lists are reseeded on random training vectors.
+            sums[empty] = train[torch.from_numpy(rng.choice(len(train), int(empty.sum())))]
+            centroids = sums / sums.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+        assign = torch.cat([
+            _assign(torch.from_numpy(_unit(get(slice(start, start + block_size)))), centroids, block_size)
+            for start in range(0, n_rows, block_size)
+        ]).numpy()
+        rows = np.argsort(assign, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+        vectors = np.empty((n_rows, emb.shape[1]), dtype=np.float32)
+        for start in range(0, n_rows, block_size):
+            vectors[start: start + block_size] = _unit(get(rows[start: start + block_size]))
+        return cls(centroids=centroids.numpy(), offsets=offsets, rows=rows, vectors=vectors, nid=nid)
+
+    @classmethod
+    def from_store(cls, store, **kwargs):
+        return cls.build(store, nid=store.nid, **kwargs)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def position(self):
+        # Row of the original matrix -> position in the list-ordered vectors.
+        if self._position is None:
+            self._position = np.empty(len(self.rows), dtype=np.int64)
+            self._position[self.rows] = np.arange(len(self.rows))
+        return self._position
+
+    def tensor(self) -> torch.Tensor:
+        # The list-ordered vectors as a tensor sharing their memory. A memory-mapped index is read-only,
+        # which torch warns about, but the tensor is never written.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(np.asarray(self.vectors))
+
+    def probe(self, queries: torch.Tensor, n_probe: int) -> torch.Tensor:
+        return torch.topk(queries @ torch.from_numpy(self.centroids).T, min(n_probe, self.n_lists), dim=1).indices
+
+    def probed_lists(self, queries: torch.Tensor, n_probe: int):
+        # Every list probed by the batch, with the queries probing it and the probe slot they use.
+        probe = self.probe(queries, n_probe)
+        for lst in torch.unique(probe).tolist():
+            query, slot = torch.nonzero(probe == lst, as_tuple=True)
+            yield lst, query, slot
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: int = 8, exclude: np.ndarray = None,
+               batch: int = 1024):
+        # Approximate top k rows by cosine similarity. exclude[i] is a row that query i must not return,
+        # -1 for none. Rows are -1 and scores -inf where the probed lists hold fewer than k candidates.
+        queries = torch.from_numpy(_unit(queries))
+        vectors = self.tensor()
+        n_probe = min(n_probe, self.n_lists)
+        exclude_pos = None if exclude is None else \
+            torch.from_numpy(np.where(exclude >= 0, self.position[np.maximum(exclude, 0)], -1))
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for start in range(0, len(queries), batch):
+            q = queries[start: start + batch]
+            cand = torch.full((len(q), n_probe * k), -np.inf)
+            cand_pos = torch.full((len(q), n_probe * k), -1, dtype=torch.int64)
+            for lst, query, slot in self.probed_lists(q, n_probe):
+                a, b = int(self.offsets[lst]), int(self.offsets[lst + 1])
+                if a == b:
+                    continue
+                sims = q[query] @ vectors[a: b].T
+                if exclude_pos is not None:
+                    own = exclude_pos[start + query]
+                    inside = (own >= a) & (own < b)
+                    sims[inside, own[inside] - a] = -np.inf
+                top = torch.topk(sims, min(k, b - a), dim=1)
+                cols = slot[:, None] * k + torch.arange(top.values.shape[1])
+                cand[query[:, None], cols] = top.values
+                cand_pos[query[:, None], cols] = top.indices + a
+            best, keep = torch.topk(cand, k, dim=1)
+            best_pos = torch.gather(cand_pos, 1, keep).numpy()
+            rows[start: start + len(q)] = np.where(best_pos >= 0, self.rows[np.maximum(best_pos, 0)], -1)
+            scores[start: start + len(q)] = best.numpy()
+        return rows, scores
+
+    def most_similar(self, int_node_ids, k: int = 10, n_probe: int = 8):
+        # The approximate counterpart of EmbeddingStore.most_similar, by int_node_id.
+        assert self.nid is not None, 'The index has no nid sidecar.'
+        query = map_nid(int_node_ids, self.nid)
+        if (query < 0).any():
+            raise KeyError(f'{int((query < 0).sum())} node ids are not in the index.')
+        rows, scores = self.search(self.vectors[self.position[query]], k=k, n_probe=n_probe, exclude=query)
+        return np.where(rows >= 0, self.nid[np.maximum(rows, 0)], -1), scores
+
+    def save(self, path):
+        check_and_mkdir(os.path.join(path, 'meta.json'))
+        for name in ('centroids', 'offsets', 'rows', 'vectors', 'nid'):
+            if getattr(self, name) is not None:
+                np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_rows': len(self), 'dim': self.vectors.shape[1], 'n_lists': self.n_lists}, f)
+        return self
+
+    @classmethod
+    def load(cls, path, mmap_mode: str = 'r'):
+        def _load(name):
+            file = os.path.join(path, f'{name}.npy')
+            return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+        # The small arrays are read in full, the vectors stay memory-mapped.
+        return cls(
+            centroids=np.load(os.path.join(path, 'centroids.npy')),
+            offsets=np.load(os.path.join(path, 'offsets.npy')),
+            rows=np.load(os.path.join(path, 'rows.npy')),
+            vectors=_load('vectors'),
+            nid=_load('nid'),
+        )
+
+
+def recall_curve(index: IVFIndex, queries: np.ndarray, k: int = 10, n_probes: tuple = (1, 2, 4, 8, 16, 32),
+                 exclude: np.ndarray = None) -> list:
+    # Recall@k of the approximate search against a scan of every list, and its throughput, per n_probe.
+    exact, _ = index.search(queries, k=k, n_probe=index.n_lists, exclude=exclude)
+    ret = list()
+    for n_probe in n_probes:
+        start_time = time.time()
+        rows, _ = index.search(queries, k=k, n_probe=n_probe, exclude=exclude)
+        elapsed = time.time() - start_time
+        hit = (rows[:, :, None] == exact[:, None, :]) & (rows[:, :, None] >= 0)
+        ret.append({
+            'n_probe': n_probe,
+            'recall': float(hit.any(axis=2).sum() / max((exact >= 0).sum(), 1)),
+            'qps': len(queries) / max(elapsed, 1e-9),
+        })
+    return ret
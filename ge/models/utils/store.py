@@ -0,0 +1,166 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from ge.utils import check_and_mkdir
+
+
+class EmbeddingStore:
+    quantizations = (None, 'float16', 'int8')
+
+    def __init__(self, emb: np.ndarray, nid: np.ndarray = None, tid: np.ndarray = None,
+                 scale: np.ndarray = None, nid_order: np.ndarray = None):
+        self.emb = emb
+        self.nid = nid
+        self.tid = tid
+        self.scale = scale
+        self._nid_order = nid_order
+        self._unit = None
+
+    @classmethod
+    def from_graph(cls, g, emb: np.ndarray):
+        nid = g.ndata['nid'].numpy() if 'nid' in g.ndata else None
+        tid = g.ndata['tid'].numpy() if 'tid' in g.ndata else None
+        return cls(emb=emb, nid=nid, tid=tid)
+
+    @property
+    def shape(self):
+        return self.emb.shape
+
+    def __len__(self):
+        return self.emb.shape[0]
+
+    @property
+    def nid_order(self):
+        if self._nid_order is None and self.nid is not None:
+            self._nid_order = np.argsort(self.nid, kind='stable')
+        return self._nid_order
+
+    def get(self, rows, dtype: type = np.float32) -> np.ndarray:
+        emb = np.asarray(self.emb[rows], dtype=dtype)
+        if self.scale is not None:
+            emb *= np.asarray(self.scale[rows], dtype=dtype)[..., None]
+        return emb
+
+    def index(self, int_node_ids) -> np.ndarray:
+        # Maps original int_node_id to dgl row, -1 if the id is not in the store.
+        assert self.nid is not None, 'The store has no nid sidecar.'
+        int_node_ids = np.asarray(int_node_ids, dtype=self.nid.dtype)
+        order = self.nid_order
+        pos = np.searchsorted(self.nid, int_node_ids, sorter=order)
+        pos = np.minimum(pos, len(order) - 1)
+        rows = order[pos]
+        return np.where(self.nid[rows] == int_node_ids, rows, -1)
+
+    def lookup(self, int_node_ids, dtype: type = np.float32) -> np.ndarray:
+        rows = self.index(int_node_ids)
+        if (rows < 0).any():
+            raise KeyError(f'{int((rows < 0).sum())} node ids are not in the store.')
+        return self.get(rows, dtype=dtype)
+
+    def _unit_vectors(self, block_size: int = 2 ** 16):
+        # L2-normalized float32 copy of the store, grouped by type so every type is one contiguous range.
+        if self._unit is None:
+            n_rows = len(self)
+            tid = np.asarray(self.tid) if self.tid is not None else np.zeros(n_rows, dtype=np.int64)
+            rows = np.argsort(tid, kind='stable')
+            offset = np.zeros(int(tid.max(initial=0)) + 2, dtype=np.int64)
+            np.cumsum(np.bincount(tid, minlength=len(offset) - 1), out=offset[1:])
+            unit = np.empty(self.shape, dtype=np.float32)
+            for start in range(0, n_rows, block_size):
+                block = self.get(rows[start: start + block_size])
+                unit[start: start + len(block)] = block / np.maximum(np.linalg.norm(block, axis=1), 1e-12)[:, None]
+            position = np.empty(n_rows, dtype=np.int64)
+            position[rows] = np.arange(n_rows)
+            self._unit = (unit, rows, position, offset)
+        return self._unit
+
+    def most_similar(self, int_node_ids, k: int = 10, node_type: list = None, type_mapping: dict = None,
+                     exclude_self: bool = True, block_size: int = 2 ** 16, memory_budget: int = 2 ** 28):
+        # Top k nodes by cosine similarity to each of int_node_ids, optionally among the given node types
+        # (type ids, or names through type_mapping). Returns int_node_ids, or rows for a store without nid,
+        # and scores, both of shape (n_queries, k) and sorted by decreasing similarity.
+        unit, rows, position, offset = self._unit_vectors()
+        query = self.index(int_node_ids) if self.nid is not None else np.asarray(int_node_ids, dtype=np.int64)
+        if (query < 0).any():
+            raise KeyError(f'{int((query < 0).sum())} node ids are not in the store.')
+        if node_type is None:
+            ranges = [(0, len(self))]
+        else:
+            types = [type_mapping[t] if type_mapping is not None else t for t in node_type]
+            ranges = [(offset[t], offset[t + 1]) for t in types if t + 1 < len(offset)]
+        k = min(k, sum(b - a for a, b in ranges))
+
+        ids = np.zeros((len(query), k), dtype=np.int64)
+        scores = np.zeros((len(query), k), dtype=np.float32)
+        unit = torch.from_numpy(unit)
+        n_query = max(1, memory_budget // (8 * block_size))
+        for q_start in range(0, len(query), n_query):
+            q_pos = torch.from_numpy(position[query[q_start: q_start + n_query]])
+            q_vec = unit[q_pos]
+            best = torch.zeros((len(q_pos), 0))
+            best_pos = torch.zeros((len(q_pos), 0), dtype=torch.int64)
+            for a, b in ranges:
+                for start in range(a, b, block_size):
+                    end = min(start + block_size, b)
+                    sims = q_vec @ unit[start: end].T
+                    if exclude_self:
+                        own = (q_pos >= start) & (q_pos < end)
+                        sims[own, q_pos[own] - start] = -np.inf
+                    # Partial selection inside the block, then against the best k found so far.
+                    top = torch.topk(sims, min(k, sims.shape[1]), dim=1)
+                    best = torch.cat([best, top.values], dim=1)
+                    best_pos = torch.cat([best_pos, top.indices + start], dim=1)
+                    best, keep = torch.topk(best, min(k, best.shape[1]), dim=1)
+                    best_pos = torch.gather(best_pos, 1, keep)
+            best_rows = rows[best_pos.numpy()]
+            ids[q_start: q_start + len(q_pos)] = self.nid[best_rows] if self.nid is not None else best_rows
+            scores[q_start: q_start + len(q_pos)] = best.numpy()
+        return ids, scores
+
+    def save(self, path, quantize: str = None, block_size: int = 2 ** 16):
+        assert quantize in self.quantizations, f'Unknown quantization {quantize}'
+        check_and_mkdir(os.path.join(path, 'meta.json'))
+
+        n_rows, dim = self.emb.shape
+        dtype = {None: np.float32, 'float16': np.float16, 'int8': np.int8}[quantize]
+        out = np.lib.format.open_memmap(os.path.join(path, 'embedding.npy'), mode='w+', dtype=dtype,
+                                        shape=(n_rows, dim))
+        scale = np.ones(n_rows, dtype=np.float32) if quantize == 'int8' else None
+        for start in range(0, n_rows, block_size):
+            block = self.get(slice(start, start + block_size))
+            if quantize == 'int8':
+                s = np.abs(block).max(axis=1) / 127
+                s[s == 0] = 1
+                scale[start: start + len(block)] = s
+                block = np.rint(block / s[:, None])
+            out[start: start + len(block)] = block
+        out.flush()
+        del out
+
+        if scale is not None:
+            np.save(os.path.join(path, 'scale.npy'), scale)
+        if self.nid is not None:
+            np.save(os.path.join(path, 'nid.npy'), self.nid)
+            np.save(os.path.join(path, 'nid_order.npy'), self.nid_order)
+        if self.tid is not None:
+            np.save(os.path.join(path, 'tid.npy'), self.tid)
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'n_rows': n_rows, 'dim': dim, 'quantize': quantize}, f)
+        return self
+
+    @classmethod
+    def load(cls, path, mmap_mode: str = 'r'):
+        def _load(name):
+            file = os.path.join(path, name)
+            return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+        return cls(
+            emb=_load('embedding.npy'),
+            nid=_load('nid.npy'),
+            tid=_load('tid.npy'),
+            scale=_load('scale.npy'),
+            nid_order=_load('nid_order.npy'),
+        )
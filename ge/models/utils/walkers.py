@@ -1,51 +1,454 @@
+import os
+import json
+import hashlib
+import logging
+import collections
+
 import dgl
+import numpy as np
 import torch
+import torch.multiprocessing as mp
 import tqdm
 from typing import Union, List
 
+from ge.models.utils.alias import alias_walk, build_alias_table
+from ge.utils import check_and_mkdir, csr_adj, hash_graph
+
+
+logger = logging.getLogger('ge')
+
+_WORKER_STATE = None
+_POW10 = 10 ** np.arange(1, 19, dtype=np.int64)
+# Seeded walks draw every block of _SEED_BLOCK walks from its own seed, so they do not depend on how the
+# blocks are sharded between workers.
+_SEED_BLOCK = 2 ** 10
+
+
+def _init_walk_worker(num_nodes, arrays, weight):
+    global _WORKER_STATE
+    # One sampling thread per process, the pool itself provides the parallelism.
+    torch.set_num_threads(1)
+    indptr, indices = arrays['indptr'], arrays['indices']
+    g = dgl.graph(('csr', (indptr, indices, torch.tensor([], dtype=indptr.dtype))), num_nodes=num_nodes)
+    if weight is not None:
+        g.edata[weight] = arrays['csr_weight']
+    _WORKER_STATE = dict(g=g, **{k: v.numpy() for k, v in arrays.items()})
+
+
+def _walk_shard(nodes, params, seeds):
+    return _sample_walks(_WORKER_STATE, nodes, params, seeds)
+
+
+def _metapath_walk(typed_key, typed_indices, nodes, params, rng):
+    # typed_key holds src * n_types + type(dst) sorted, so the neighbours of a node with a given type
+    # are one contiguous range found by binary search.
+    path_types = params['metapath'][1:]
+    walks = np.full((len(nodes), params['walk_length'] + 1), -1, dtype=np.int64)
+    walks[:, 0] = cur = np.asarray(nodes, dtype=np.int64)
+    alive = np.arange(len(nodes))
+    for t in range(params['walk_length']):
+        key = cur[alive] * params['n_types'] + path_types[t % len(path_types)]
+        lo = np.searchsorted(typed_key, key, side='left')
+        cnt = np.searchsorted(typed_key, key, side='right') - lo
+        ok = cnt > 0
+        alive, lo, cnt = alive[ok], lo[ok], cnt[ok]
+        if len(alive) == 0:
+            break
+        nxt = typed_indices[lo + (rng.random(len(alive)) * cnt).astype(np.int64)]
+        cur[alive] = nxt
+        walks[alive, t + 1] = nxt
+    return walks
+
+
+def _filter_types(walks, tid, keep_types):
+    # Moves the tokens of kept types to the front of each walk and pads the rest with -1.
+    keep = (walks >= 0) & np.isin(tid[np.maximum(walks, 0)], keep_types)
+    order = np.argsort(~keep, axis=1, kind='stable')
+    walks = np.take_along_axis(walks, order, axis=1)
+    walks[~np.take_along_axis(keep, order, axis=1)] = -1
+    return walks
+
+
+class WalkChunk:
+    # Variable-length walks in CSR layout, walk i is values[indptr[i]: indptr[i + 1]].
+    def __init__(self, indptr: np.ndarray, values: np.ndarray):
+        self.indptr = indptr
+        self.values = values
+
+    @classmethod
+    def from_padded(cls, walks: np.ndarray):
+        # Padding only ever trails the walk: dgl dead ends, metapath dead ends and dropped node types.
+        keep = walks >= 0
+        indptr = np.zeros(len(walks) + 1, dtype=np.int64)
+        np.cumsum(keep.sum(axis=1), out=indptr[1:])
+        return cls(indptr=indptr, values=walks[keep])
+
+    @property
+    def lengths(self):
+        return np.diff(self.indptr)
+
+    @property
+    def walk_index(self):
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, item: slice):
+        start, stop, _ = item.indices(len(self))
+        stop = max(start, stop)
+        indptr = self.indptr[start: stop + 1]
+        return WalkChunk(indptr=indptr - indptr[0], values=self.values[indptr[0]: indptr[-1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.values[self.indptr[i]: self.indptr[i + 1]]
+
+
+def _padded_walks(state, nodes, params, seed):
+    if params['metapath'] is not None:
+        walks = _metapath_walk(state['typed_key'], state['typed_indices'], nodes.numpy(), params,
+                               np.random.default_rng(seed))
+    elif params['alias']:
+        walks = alias_walk(state['indptr'], state['indices'], state.get('alias_prob'), state.get('alias'),
+                           nodes.numpy(), params['walk_length'], np.random.default_rng(seed))
+    else:
+        if seed is not None:
+            dgl.seed(seed)
+        walks = dgl.sampling.node2vec_random_walk(
+            g=state['g'],
+            nodes=nodes,
+            p=params['p'],
+            q=params['q'],
+            walk_length=params['walk_length'],
+            prob=params['weight']
+        ).numpy()
+    return walks.astype(RandomWalk.dtype)
+
+
+def _sample_walks(state, nodes, params, seeds):
+    # nodes holds one block of _SEED_BLOCK walks per seed, or a single block when unseeded.
+    if seeds[0] is None:
+        walks = _padded_walks(state, nodes, params, None)
+    else:
+        walks = np.concatenate([_padded_walks(state, block, params, seed)
+                                for block, seed in zip(torch.split(nodes, _SEED_BLOCK), seeds)])
+    if params['node_type'] is not None:
+        walks = _filter_types(walks, state['tid'], params['node_type'])
+    return WalkChunk.from_padded(walks)
+
+
+def _walks_to_bytes(values, indptr):
+    # Renders every token's decimal digits at once, walk i spans values[indptr[i]: indptr[i + 1]].
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return b''
+    neg = values < 0
+    absval = np.abs(values)
+    n_digits = np.searchsorted(_POW10, absval, side='right') + 1
+    width = n_digits + neg + 1
+    end = np.cumsum(width)
+
+    buf = np.full(end[-1], ord(' '), dtype=np.uint8)
+    buf[(end - width)[neg]] = ord('-')
+    lengths = np.diff(indptr)
+    buf[end[np.asarray(indptr[1:])[lengths > 0] - 1] - 1] = ord('\n')
+    last_digit = end - 2
+    for k in range(n_digits.max()):
+        mask = n_digits > k
+        buf[last_digit[mask] - k] = ord('0') + (absval[mask] // 10 ** k) % 10
+    return buf.tobytes()
+
 
 class RandomWalk:
-    def __init__(self, g: dgl.DGLGraph, walk_length: int, batch_size: int = 1e7, path_type: type = int,
-                 p: float = 1, q: float = 1, node_type: [List[str], None] = None,
-                 verbose: bool = False):
+    dtype = np.int32
+
+    def __init__(self, g: dgl.DGLGraph, walk_length: int, batch_size: int = None, memory_budget: int = 2 ** 30,
+                 path_type: type = int, p: float = 1, q: float = 1,
+                 node_type: [List[Union[str, int]], None] = None, metapath: [List[Union[str, int]], None] = None,
+                 type_mapping: dict = None, num_walks_per_node: int = 1, weight: str = None,
+                 start_sampling: str = 'uniform', start_nodes: [torch.Tensor, np.ndarray, None] = None,
+                 n_jobs: int = 1, prefetch: int = None, seed: int = None,
+                 cache_dir: str = None, graph_id: str = None, verbose: bool = False):
+        assert start_sampling in ('uniform', 'degree'), f'Unknown start sampling {start_sampling}'
         self.g = g
         self.walk_length = walk_length
-        self.batch_size = int(batch_size)
+        self.memory_budget = int(memory_budget)
         self.path_type = path_type
         self.p = p
         self.q = q
         self.node_type = node_type
+        self.metapath = metapath
+        self.type_mapping = type_mapping
+        self.num_walks_per_node = num_walks_per_node
+        self.weight = weight
+        self.start_sampling = start_sampling
+        self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count()
+        self.prefetch = prefetch if prefetch is not None else 2 * self.n_jobs
+        self.seed = seed
+        self.cache_dir = cache_dir
+        self.graph_id = graph_id
         self.verbose = verbose
         self.n_nodes = self.g.num_nodes()
+        self.n_types = int(self.g.ndata['tid'].max()) + 1 if 'tid' in self.g.ndata else 0
+        self.batch_size = int(batch_size) if batch_size is not None else self._budget_batch_size()
+        self._epoch = 0
+        self._cache_key = None
+        self._arrays = None
+        self._pool = None
+        self._shared = None
+        assert self.n_nodes < np.iinfo(self.dtype).max, f'Too many nodes for {np.dtype(self.dtype).name} walks.'
+        if self.metapath is not None:
+            assert len(self.metapath) > 1 and self.metapath[0] == self.metapath[-1], \
+                'A metapath must start and end with the same node type.'
+            assert self.weight is None, 'Metapath walks are unweighted.'
+        self.start_nodes = self._start_nodes(start_nodes)
 
-    def _walk(self, nodes):
-        walk_path = dgl.sampling.node2vec_random_walk(
-            g=self.g,
-            nodes=nodes,
-            p=self.p,
-            q=self.q,
-            walk_length=self.walk_length
-        )
-        return walk_path
-
-    def to_txt(self, path):
-        _type = self.path_type
-        self.path_type = str
-        with open(path, 'w', encoding='utf-8') as f:
-            for line in tqdm.tqdm(self, disable=not self.verbose):
-                f.write(' '.join(line) + '\n')
+    def _type_ids(self, types):
+        if types is None:
+            return None
+        return [self.type_mapping[t] if isinstance(t, str) else int(t) for t in types]
 
-    def __len__(self):
-        return self.n_nodes
+    def _start_nodes(self, nodes=None):
+        if nodes is not None:
+            nodes = torch.as_tensor(nodes, dtype=torch.int64)
+        if self.metapath is None:
+            return nodes
+        tid = self.g.ndata['tid']
+        if nodes is None:
+            return torch.nonzero(tid == self._type_ids(self.metapath)[0], as_tuple=True)[0]
+        return nodes[tid[nodes] == self._type_ids(self.metapath)[0]]
 
-    def __iter__(self):
+    @property
+    def starts_every_node(self):
+        # Uniform starts over the whole graph begin a walk from every node, so every node id is emitted.
+        return self.start_nodes is None and self.start_sampling == 'uniform'
+
+    def _walk_params(self):
+        node_type = self._type_ids(self.node_type)
+        return {
+            'walk_length': self.walk_length,
+            'p': self.p,
+            'q': self.q,
+            'metapath': self._type_ids(self.metapath),
+            'node_type': np.asarray(node_type) if node_type is not None else None,
+            'n_types': self.n_types,
+            'weight': self.weight,
+            # First-order walks are sampled in numpy, from alias tables when weighted. dgl only seeds the
+            # calling thread's generators, so seeded walks read from another thread would not repeat.
+            'alias': self.p == 1 and self.q == 1 and (self.weight is not None or self.seed is not None),
+        }
+
+    def _walk_arrays(self):
+        # Per-graph lookup tables, built once and shared with the walk workers.
+        if self._arrays is not None:
+            return self._arrays
+        indptr, indices, eids = csr_adj(self.g)
+        indptr, indices = indptr.numpy(), indices.numpy()
+        self._arrays = dict(indptr=indptr, indices=indices)
+        if self.node_type is not None or self.metapath is not None:
+            tid = self.g.ndata['tid'].numpy()
+            self._arrays['tid'] = tid
+        if self.weight is not None:
+            self._arrays['csr_weight'] = self.g.edata[self.weight][eids.long()].numpy()
+            if self.p == 1 and self.q == 1:
+                self._arrays['alias_prob'], self._arrays['alias'] = self._alias_table(indptr)
+        if self.metapath is not None:
+            typed_key = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(indptr)) * self.n_types \
+                + tid[indices]
+            order = np.argsort(typed_key, kind='stable')
+            self._arrays['typed_key'] = typed_key[order]
+            self._arrays['typed_indices'] = indices[order]
+        return self._arrays
+
+    def _alias_table(self, indptr):
+        path = None
+        if self.cache_dir is not None:
+            key = hashlib.md5(json.dumps([self.graph_id or hash_graph(self.g), self._weight_key()]).encode()).hexdigest()
+            path = os.path.join(self.cache_dir, f'alias_{key}.npz')
+            if os.path.exists(path):
+                tables = np.load(path)
+                return tables['prob'], tables['alias']
+        prob, alias = build_alias_table(indptr, self._arrays['csr_weight'])
+        if path is not None:
+            check_and_mkdir(path)
+            np.savez(path, prob=prob, alias=alias)
+        return prob, alias
+
+    def _weight_key(self):
+        if self.weight is None or self.graph_id is not None:
+            return self.weight
+        # hash_graph only covers the structure, reweighted edges must not hit a stale cache.
+        return [self.weight, hashlib.md5(self.g.edata[self.weight].numpy().tobytes()).hexdigest()]
+
+    def _budget_batch_size(self):
+        # Each walk is sampled as int64 by dgl and then kept as a compact chunk until consumed.
+        walk_bytes = (self.walk_length + 1) * (np.dtype(np.int64).itemsize + np.dtype(self.dtype).itemsize)
+        in_flight = 1 if self.n_jobs <= 1 else self.n_jobs + self.prefetch
+        return max(1, self.memory_budget // (walk_bytes * in_flight))
+
+    def _cache_params(self):
+        return {
+            'graph': self.graph_id or hash_graph(self.g),
+            'walk_length': self.walk_length,
+            'p': self.p,
+            'q': self.q,
+            'seed': self.seed,
+            'node_type': self._type_ids(self.node_type),
+            'metapath': self._type_ids(self.metapath),
+            'num_walks_per_node': self.num_walks_per_node,
+            'weight': self._weight_key(),
+            'start_sampling': self.start_sampling,
+            'start_nodes': None if self.start_nodes is None
+            else hashlib.md5(self.start_nodes.numpy().tobytes()).hexdigest(),
+        }
+
+    @property
+    def cache_path(self):
+        if self.cache_dir is None:
+            return None
+        if self._cache_key is None:
+            self._cache_key = hashlib.md5(json.dumps(self._cache_params(), sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'walks_{self._cache_key}')
+
+    def _walk(self, nodes, seeds=(None,), params=None):
+        state = dict(g=self.g, **self._walk_arrays())
+        return _sample_walks(state, nodes, params or self._walk_params(), seeds)
+
+    def _block_seeds(self):
+        # Walks differ between passes but are reproducible for a given seed and pass.
+        n_blocks = -(-len(self) // _SEED_BLOCK)
+        states = np.random.SeedSequence([self.seed, self._epoch]).generate_state(n_blocks)
+        return [int(s) & 0x7fffffff for s in states]
+
+    def _node_order(self):
+        nodes = torch.arange(self.n_nodes) if self.start_nodes is None else self.start_nodes
+        if self.start_sampling == 'degree':
+            # High-degree nodes start proportionally more of the walks.
+            deg = self.g.out_degrees(nodes).numpy().astype(np.float64)
+            if deg.sum() > 0:
+                rng = np.random.default_rng(None if self.seed is None else [self.seed, self._epoch])
+                return torch.from_numpy(rng.choice(nodes.numpy(), size=len(self), p=deg / deg.sum()))
+        generator = None if self.seed is None else torch.Generator().manual_seed(self.seed + self._epoch)
+        order = torch.randperm(len(self), generator=generator)
+        return nodes.repeat(self.num_walks_per_node)[order]
+
+    def _iter_serial(self, shards, seeds):
+        params = self._walk_params()
+        for nodes, shard_seeds in zip(shards, seeds):
+            yield self._walk(nodes, shard_seeds, params)
+
+    def _walk_pool(self):
+        # The workers and the graph arrays they share are set up once and serve every pass until close.
+        if self._pool is None:
+            self._shared = {k: torch.from_numpy(v).share_memory_() for k, v in self._walk_arrays().items()}
+            self._pool = mp.get_context('spawn').Pool(self.n_jobs, initializer=_init_walk_worker,
+                                                      initargs=(self.n_nodes, self._shared, self.weight))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            self._shared = None
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+
+    def _iter_parallel(self, shards, seeds):
+        pool = self._walk_pool()
+        params = self._walk_params()
+        pending = collections.deque()
+        for nodes, shard_seeds in zip(shards, seeds):
+            pending.append(pool.apply_async(_walk_shard, (nodes, params, shard_seeds)))
+            if len(pending) >= self.prefetch:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def _generate(self):
         _batch = self.batch_size
-        nodes = torch.randperm(self.n_nodes)
+        if self.n_jobs > 1:
+            # Keep every worker busy even when batch_size covers the whole graph.
+            _batch = max(1, min(_batch, -(-len(self) // (4 * self.n_jobs))))
+        if self.seed is not None:
+            # Shards are whole seed blocks, so seeded walks do not depend on n_jobs or batch_size.
+            _batch = max(1, _batch // _SEED_BLOCK) * _SEED_BLOCK
+        nodes = self._node_order()
+        shards = [nodes[i: i + _batch] for i in range(0, len(self), _batch)]
+        if self.seed is None:
+            seeds = [(None,)] * len(shards)
+        else:
+            block_seeds = self._block_seeds()
+            seeds = [block_seeds[i // _SEED_BLOCK: (i + _batch) // _SEED_BLOCK] for i in range(0, len(self), _batch)]
+        self._epoch += 1
+
+        if self.n_jobs > 1 and len(shards) > 1:
+            yield from self._iter_parallel(shards, seeds)
+        else:
+            yield from self._iter_serial(shards, seeds)
+
+    def _materialize(self, path):
+        if self.verbose:
+            logger.info(f'Start to materialize walks into {path}')
+        check_and_mkdir(path)
+        lengths = list()
+        with open(path + '.values.tmp', 'wb') as f:
+            for chunk in self._generate():
+                f.write(np.ascontiguousarray(chunk.values, dtype=self.dtype).tobytes())
+                lengths.append(chunk.lengths)
+        indptr = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.concatenate(lengths), out=indptr[1:])
+        np.save(path + '.indptr.tmp.npy', indptr)
+        # The indptr file marks a complete cache, so it is moved last.
+        os.replace(path + '.values.tmp', path + '.values.bin')
+        os.replace(path + '.indptr.tmp.npy', path + '.indptr.npy')
 
-        for i in range(self.n_nodes // _batch + int(self.n_nodes % _batch != 0)):
-            l, r = i * _batch, (i + 1) * _batch
-            for path in self._walk(nodes[l: r]).tolist():
+    def materialize(self):
+        path = self.cache_path
+        assert path is not None, 'Materializing walks needs a cache_dir.'
+        if not os.path.exists(path + '.indptr.npy'):
+            self._materialize(path)
+        elif self.verbose:
+            logger.info(f'Reuse cached walks {path}')
+        return path
+
+    def iter_chunks(self):
+        if self.cache_path is None:
+            yield from self._generate()
+            return
+
+        path = self.materialize()
+        indptr = np.load(path + '.indptr.npy', mmap_mode='r')
+        values = np.memmap(path + '.values.bin', dtype=self.dtype, mode='r') if indptr[-1] > 0 \
+            else np.zeros(0, dtype=self.dtype)
+        for i in range(0, len(indptr) - 1, self.batch_size):
+            chunk_indptr = np.asarray(indptr[i: i + self.batch_size + 1])
+            yield WalkChunk(indptr=chunk_indptr - chunk_indptr[0],
+                            values=values[chunk_indptr[0]: chunk_indptr[-1]])
+
+    def to_txt(self, path, rows_per_write: int = None):
+        rows_per_write = rows_per_write or max(1, 2 ** 22 // (self.walk_length + 1))
+        n_words = 0
+        with open(path, 'wb') as f:
+            for chunk in tqdm.tqdm(self.iter_chunks(), disable=not self.verbose):
+                for i in range(0, len(chunk), rows_per_write):
+                    rows = chunk[i: i + rows_per_write]
+                    f.write(_walks_to_bytes(rows.values, rows.indptr))
+                    n_words += len(rows.values)
+        return n_words
+
+    def __len__(self):
+        n_start = self.n_nodes if self.start_nodes is None else len(self.start_nodes)
+        return n_start * self.num_walks_per_node
+
+    def __iter__(self):
+        # Tokens are built one walk at a time so only the compact chunk stays resident.
+        for chunk in self.iter_chunks():
+            for walk in chunk:
                 if self.path_type != int:
-                    yield [self.path_type(p) for p in path]
+                    yield [self.path_type(p) for p in walk.tolist()]
                 else:
-                    yield path
+                    yield walk.tolist()
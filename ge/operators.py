@@ -196,6 +196,7 @@ class DropDuplicatesFilter(_Operator):
         query = f"""
             {self.name} as (
                 select {', '.join(group_by_list)}
+                       ,count(1) as {self.params.edge_weight_col}
                 from {depend_table or self.params.graph_table}
                 group by {', '.join(group_by_list)}
             )
@@ -1,13 +1,39 @@
 import hashlib
 import json
 from typing import List, Tuple, ClassVar
-from dataclasses import asdict, dataclass, field
+from dataclasses import dataclass, field, fields, is_dataclass
+
+
+def _canonical(value):
+    # JSON-ready form that does not depend on container types, key order or number types: lists and
+    # tuples compare equal, sets are sorted, 1 and 1.0 agree, and numpy scalars become python ones.
+    if is_dataclass(value) and not isinstance(value, type):
+        return {f.name: _canonical(getattr(value, f.name)) for f in fields(value)}
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_canonical(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if hasattr(value, 'item') and not isinstance(value, (int, float)):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    return repr(value)
+
+
+def canonical_hash(value) -> str:
+    return hashlib.md5(json.dumps(_canonical(value), sort_keys=True, separators=(',', ':')).encode()).hexdigest()
 
 
 @dataclass(frozen=True)
 class _Params:
     def hash_id(self):
-        return hashlib.md5(json.dumps(asdict(self)).encode()).hexdigest()
+        return canonical_hash(self)
 
 
 @dataclass(frozen=True)
@@ -15,6 +41,7 @@ class _DefaultParams:
     src_type_value: ClassVar[str] = 'acct'
     src_id_col: ClassVar[str] = 'src_id'
     tgt_id_col: ClassVar[str] = 'tgt_id'
+    edge_weight_col: ClassVar[str] = 'edge_cnt'
 
 
 @dataclass(frozen=True)
@@ -54,3 +81,29 @@ class Acct2AssetDataParams(_DataParams, _FilterParams, _SaveParams):
 class Acct2AcctDataParams(_DataParams, _FilterParams, _SaveParams):
     pass
 
+
+@dataclass(frozen=True)
+class WalkParams(_Params):
+    walk_length: int = 200
+    p: float = 1
+    q: float = 1
+    num_walks_per_node: int = 1
+    weight: str = None
+    start_sampling: str = 'uniform'
+    node_type: List[str] = None
+    metapath: List[str] = None
+    seed: int = 1
+
+
+@dataclass(frozen=True)
+class TrialParams(WalkParams):
+    model: str = 'DeepWalk'
+    window: int = 10
+    emb_size: int = 64
+    epochs: int = 3
+    loss: str = 'hs'
+    negative: int = 5
+
+    @property
+    def walk_params(self) -> WalkParams:
+        return WalkParams(**{f: getattr(self, f) for f in WalkParams.__dataclass_fields__})
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import logging
+import itertools
+import multiprocessing as mp
+from typing import List
+
+import dgl
+import numpy as np
+
+from ge.evaluation import kg_metrics
+from ge.models import DeepWalk, Node2VecWalk, SkipGram
+from ge.models.utils.walkers import RandomWalk
+from ge.params import TrialParams
+from ge.utils import check_and_mkdir, hash_graph
+
+logger = logging.getLogger('ge')
+
+MODELS = {
+    'DeepWalk': DeepWalk,
+    'Node2VecWalk': Node2VecWalk,
+    'SkipGram': SkipGram,
+}
+
+_SWEEP_GRAPH = None
+
+
+def _init_sweep_worker(graph_path):
+    # Each pool process loads the graph once and reuses it for every trial it runs.
+    global _SWEEP_GRAPH
+    _SWEEP_GRAPH = dgl.load_graphs(graph_path)[0][0]
+
+
+def _model_kwargs(trial: TrialParams, type_mapping: dict = None) -> dict:
+    kwargs = dict(
+        walk_length=trial.walk_length,
+        window=trial.window,
+        emb_size=trial.emb_size,
+        epochs=trial.epochs,
+        seed=trial.seed,
+        node_type=trial.node_type,
+        type_mapping=type_mapping,
+        num_walks_per_node=trial.num_walks_per_node,
+        weight=trial.weight,
+        start_sampling=trial.start_sampling,
+    )
+    if trial.model != 'Node2VecWalk':
+        kwargs['metapath'] = trial.metapath
+    if trial.model != 'DeepWalk':
+        kwargs.update(p=trial.p, q=trial.q)
+    else:
+        assert trial.p == 1 and trial.q == 1, 'DeepWalk walks are unbiased, use Node2VecWalk for p/q.'
+    if trial.model == 'SkipGram':
+        kwargs['negative'] = trial.negative
+    else:
+        kwargs.update(loss=trial.loss, negative=trial.negative)
+    return kwargs
+
+
+def _run_trial(trial: TrialParams, graph_id: str, cache_dir: str, type_mapping: dict, n_jobs: int,
+               n_sample: int, result_path: str):
+    g = _SWEEP_GRAPH
+    start_time = time.time()
+    model = MODELS[trial.model](g, n_jobs=n_jobs, cache_dir=cache_dir, graph_id=graph_id, verbose=False,
+                                **_model_kwargs(trial, type_mapping))
+    model.train()
+    train_time = time.time() - start_time
+    # The evaluation sample is fixed by the trial seed, so trials are compared on the same nodes.
+    metrics = kg_metrics(g, model.get_embedding(), n_sample=min(n_sample, g.num_nodes()), seed=trial.seed,
+                         verbose=False)
+    record = {
+        'hash_id': trial.hash_id(),
+        'graph_id': graph_id,
+        'params': trial.__dict__,
+        'metrics': {k: float(v) for k, v in metrics.items() if not k.startswith('_')},
+        'train_time': train_time,
+    }
+    check_and_mkdir(result_path)
+    with open(result_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(record, f)
+    os.replace(result_path + '.tmp', result_path)
+    return record
+
+
+def grid(**space) -> List[TrialParams]:
+    # grid(model=['DeepWalk'], window=[5, 10], emb_size=[32, 64]) -> one TrialParams per combination.
+    keys = list(space)
+    return [TrialParams(**dict(zip(keys, values))) for values in itertools.product(*(space[k] for k in keys))]
+
+
+class Sweep:
+    def __init__(self, g: dgl.DGLGraph, trials: List[TrialParams], result_dir: str, cache_dir: str = None,
+                 type_mapping: dict = None, n_procs: int = 1, n_jobs: int = -1, n_sample: int = 1000,
+                 graph_id: str = None, verbose: bool = True):
+        self.g = g
+        self.trials = trials
+        self.result_dir = result_dir
+        self.cache_dir = cache_dir or os.path.join(result_dir, 'cache')
+        self.type_mapping = type_mapping
+        self.n_procs = n_procs
+        self.n_jobs = n_jobs if n_jobs != -1 else mp.cpu_count()
+        self.n_sample = n_sample
+        self.graph_id = graph_id or hash_graph(g)
+        self.verbose = verbose
+
+    def result_path(self, trial: TrialParams):
+        return os.path.join(self.result_dir, f'{trial.hash_id()}.json')
+
+    def load_result(self, trial: TrialParams):
+        path = self.result_path(trial)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            record = json.load(f)
+        return record if record['graph_id'] == self.graph_id else None
+
+    def _materialize_walks(self, trials):
+        # Trials that only differ in training parameters read the same cached walk corpus.
+        groups = {t.walk_params.hash_id(): t.walk_params for t in trials}
+        for i, walk in enumerate(groups.values()):
+            walker = RandomWalk(
+                g=self.g,
+                walk_length=walk.walk_length,
+                p=walk.p,
+                q=walk.q,
+                node_type=walk.node_type,
+                metapath=walk.metapath,
+                type_mapping=self.type_mapping,
+                num_walks_per_node=walk.num_walks_per_node,
+                weight=walk.weight,
+                start_sampling=walk.start_sampling,
+                n_jobs=self.n_jobs,
+                seed=walk.seed,
+                cache_dir=self.cache_dir,
+                graph_id=self.graph_id,
+                verbose=self.verbose,
+            )
+            walker.materialize()
+            walker.close()
+            if self.verbose:
+                logger.info(f'Walk corpus {i + 1}/{len(groups)} ready')
+
+    def run(self) -> List[dict]:
+        records = {t.hash_id(): self.load_result(t) for t in self.trials}
+        todo = list({t.hash_id(): t for t in self.trials if records[t.hash_id()] is None}.values())
+        if self.verbose:
+            logger.info(f'{len(self.trials) - len(todo)} of {len(self.trials)} trials are already done')
+        if len(todo) > 0:
+            self._materialize_walks(todo)
+            graph_path = os.path.join(self.cache_dir, f'graph_{self.graph_id}.bin')
+            if not os.path.exists(graph_path):
+                check_and_mkdir(graph_path)
+                dgl.save_graphs(graph_path, [self.g])
+
+            n_procs = min(self.n_procs, len(todo))
+            ctx = mp.get_context('spawn')
+            with ctx.Pool(n_procs, initializer=_init_sweep_worker, initargs=(graph_path,)) as pool:
+                pending = [
+                    pool.apply_async(_run_trial, (
+                        t, self.graph_id, self.cache_dir, self.type_mapping, max(1, self.n_jobs // n_procs),
+                        self.n_sample, self.result_path(t)
+                    ))
+                    for t in todo
+                ]
+                for t, r in zip(todo, pending):
+                    try:
+                        records[t.hash_id()] = r.get()
+                    except Exception as e:
+                        # A failed trial is reported without a result file, so the next run retries it.
+                        logger.warning(f'Trial {t.hash_id()} failed: {type(e).__name__}: {e}')
+                        records[t.hash_id()] = {
+                            'hash_id': t.hash_id(),
+                            'graph_id': self.graph_id,
+                            'params': t.__dict__,
+                            'error': f'{type(e).__name__}: {e}',
+                        }
+                        continue
+                    if self.verbose:
+                        logger.info(f'Trial {t.hash_id()} done: {records[t.hash_id()]["metrics"]}')
+                pool.close()
+                pool.join()
+        return [records[t.hash_id()] for t in self.trials]
+
+    @staticmethod
+    def best(records: List[dict], metric: str = 'MRR') -> dict:
+        records = [r for r in records if 'metrics' in r]
+        return records[int(np.argmax([r['metrics'][metric] for r in records]))]
@@ -1,4 +1,9 @@
+import hashlib
 import pathlib
+import contextlib
+
+import numpy as np
+import torch
 
 
 def check_and_mkdir(path):
@@ -7,4 +12,66 @@ def check_and_mkdir(path):
         return
     check_and_mkdir(path)
     if not path.exists():
-        path.mkdir()
\ No newline at end of file
+        path.mkdir()
+
+
+@contextlib.contextmanager
+def torch_threads(n_jobs):
+    # Runs the block with n_jobs intra-op threads and restores the previous setting, None leaves it as is.
+    n_threads = torch.get_num_threads()
+    if n_jobs is not None:
+        torch.set_num_threads(max(1, n_jobs))
+    try:
+        yield
+    finally:
+        torch.set_num_threads(n_threads)
+
+
+def csr_adj(g):
+    # dgl>=1.0 renamed adj_sparse to adj_tensors.
+    if hasattr(g, 'adj_tensors'):
+        return g.adj_tensors('csr')
+    return g.adj_sparse('csr')
+
+
+def hash_graph(g):
+    indptr, indices, _ = csr_adj(g)
+    md5 = hashlib.md5()
+    md5.update(np.array([g.num_nodes(), g.num_edges()], dtype=np.int64).tobytes())
+    md5.update(indptr.numpy().tobytes())
+    md5.update(indices.numpy().tobytes())
+    return md5.hexdigest()
+
+
+def map_nid(nid, target_nid):
+    # Position of every nid in target_nid, -1 where the node is missing.
+    nid = np.asarray(nid)
+    target_nid = np.asarray(target_nid)
+    if len(target_nid) == 0:
+        return np.full(len(nid), -1, dtype=np.int64)
+    order = np.argsort(target_nid, kind='stable')
+    pos = np.minimum(np.searchsorted(target_nid, nid, sorter=order), len(order) - 1)
+    rows = order[pos]
+    return np.where(target_nid[rows] == nid, rows, -1)
+
+
+def changed_nodes(prev_g, g):
+    # Nodes of g that are new or whose neighbourhood differs from prev_g, matched through ndata['nid'].
+    nid, prev_nid = g.ndata['nid'].numpy(), prev_g.ndata['nid'].numpy()
+    n_nodes = g.num_nodes()
+    prev_to_new = map_nid(prev_nid, nid)
+    new_nodes = np.flatnonzero(map_nid(nid, prev_nid) < 0)
+
+    u, v = (e.numpy() for e in g.edges())
+    prev_u, prev_v = (prev_to_new[e.numpy()] for e in prev_g.edges())
+    # Edges to removed nodes only change their surviving endpoint.
+    dropped = (prev_u < 0) | (prev_v < 0)
+    touched = np.concatenate([prev_u[dropped], prev_v[dropped]])
+    prev_u, prev_v = prev_u[~dropped], prev_v[~dropped]
+
+    key = u.astype(np.int64) * n_nodes + v
+    prev_key = prev_u.astype(np.int64) * n_nodes + prev_v
+    added = ~np.isin(key, prev_key)
+    removed = ~np.isin(prev_key, key)
+    nodes = np.concatenate([new_nodes, touched[touched >= 0], u[added], v[added], prev_u[removed], prev_v[removed]])
+    return np.unique(nodes)
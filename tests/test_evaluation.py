@@ -0,0 +1,30 @@
+import dgl
+import numpy as np
+
+from ge.evaluation import kg_metrics, neighbors, sampled_rank
+
+
+def _star():
+    # Node 0 linked to nodes 1 and 2, node 3 to 4, node 5 isolated.
+    src, dst = [0, 0, 3], [1, 2, 4]
+    return dgl.graph((src + dst, dst + src), num_nodes=6)
+
+
+def test_tied_neighbours_share_their_rank():
+    g = _star()
+    emb = np.random.default_rng(0).normal(size=(6, 4)).astype(np.float32)
+    emb[2] = emb[1]
+    nodes = np.array([0])
+    rank = sampled_rank(emb, nodes, *neighbors(g, nodes))
+    assert rank[0] == rank[1] >= 1
+    assert kg_metrics(g, emb, 6, seed=0, verbose=False)['_rank'].min() >= 1
+
+
+def test_zero_rows_are_skipped():
+    g = _star()
+    emb = np.random.default_rng(0).normal(size=(6, 4)).astype(np.float32)
+    emb[[1, 2]] = 0
+    metrics = kg_metrics(g, emb, 6, seed=0, verbose=False)
+    # Node 0 only has zero neighbours and the zero rows are not queried, which leaves 3 -> 4 and 4 -> 3.
+    assert metrics['n_skipped'] == 2
+    assert len(metrics['_rank']) == 2